@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import json
+import platform
+import random
+import sys
+import tracemalloc
+from math import log
+from time import perf_counter
+
+import mrge
+
+# Benchmark of the extractor modes on seeded synthetic sources. Results are written as JSON that can be compared with
+# the results of another version:   python bench.py -o new.json --compare old.json
+
+
+def uniformBytes(rng, n):
+    return [rng.randrange(256) for _ in range(n)]
+
+
+def skewedBinary(rng, n):
+    return [int(rng.random() >= skewedP0) for _ in range(n)]
+
+
+def zipfStrings(rng, n):
+    return ['w' + str(rank) for rank in rng.choices(range(1, len(zipfWeights) + 1), cum_weights=zipfCumulative, k=n)]
+
+
+def floatNoise(rng, n):
+    return [rng.gauss(0., 1.) for _ in range(n)]
+
+
+def distinctFloats(rng, n):
+    return [rng.random() for _ in range(n)]
+
+
+def entropyOf(probabilities):
+    return -sum(p * log(p, 2) for p in probabilities if p)
+
+
+skewedP0 = 0.8
+zipfWeights = [1. / rank ** 1.1 for rank in range(1, 1001)]
+zipfCumulative = []
+for weight in zipfWeights:
+    zipfCumulative.append(weight + (zipfCumulative[-1] if zipfCumulative else 0.))
+
+# name: (generator, entropy of the source in bits per event or None for continuous sources)
+sources = {'uniformBytes': (uniformBytes, 8.),
+           'skewedBinary': (skewedBinary, entropyOf((skewedP0, 1 - skewedP0))),
+           'zipfStrings': (zipfStrings, entropyOf(w / zipfCumulative[-1] for w in zipfWeights)),
+           'floatNoise': (floatNoise, None),
+           'distinctFloats': (distinctFloats, None)}
+
+# name: (Extractor method, Extractor parameters, sources the mode makes sense for)
+numeric = ('uniformBytes', 'skewedBinary', 'floatNoise', 'distinctFloats')
+modes = {'next': ('next', {}, numeric),
+         'next2': ('next2', {}, numeric),
+         'revBlock': ('next2', {'revBlock': 64}, numeric),
+         'revEntropy': ('next2', {'revEntropy': 32}, numeric),
+         'rounding': ('next2', {'rounding': 0.05}, ('floatNoise', 'distinctFloats')),
+         'fixed': ('next2', {'fixed': {0: 4, 1: 1}}, ('skewedBinary',)),
+         'string': ('next2', {'str2cmp': str}, ('zipfStrings',))}
+
+
+def runCase(mode, data, budget):
+    '''
+    Feed data to a new extractor of the mode until data or time budget ends
+    return events done, seconds spent, output digits and the extractor
+    '''
+    method, params, _ = modes[mode]
+    e = mrge.Extractor(**params)
+    step = getattr(e, method)
+    digits = 0
+    events = 0
+    started = perf_counter()
+    deadline = started + budget if budget else None
+    for item in data:
+        succ, out = step(item)
+        if succ:
+            digits += len(out)
+        events += 1
+        # checking the clock every event would be seen in fast modes
+        if deadline and events & 63 == 0 and perf_counter() > deadline:
+            break
+    return events, perf_counter() - started, digits, e
+
+
+def peakMemory(mode, data):
+    tracemalloc.start()
+    try:
+        runCase(mode, data, 0)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(sourceNames, modeNames, lengths, seed=1, budget=0., memory=True, repeat=1):
+    results = []
+    for sourceName in sourceNames:
+        generator, sourceEntropy = sources[sourceName]
+        for modeName in modeNames:
+            if sourceName not in modes[modeName][2]:
+                continue
+            curve = []
+            for length in lengths:
+                data = generator(random.Random(seed), length)
+                events, seconds, digits, e = runCase(modeName, data, budget)
+                # the fastest run of the same events is the least disturbed one
+                for _ in range(repeat - 1):
+                    seconds = min(seconds, runCase(modeName, data[:events], 0)[1])
+                total = e.totalEvents()
+                # plug-in entropy of the events seen, the most an extractor of the stream statistics can give
+                empirical = e.getTotalTheoreticalEntropy() / total if total else 0.
+                result = {'source': sourceName, 'mode': modeName, 'length': length, 'events': events,
+                          'truncated': events < length, 'seconds': seconds,
+                          'eventsPerSecond': events / seconds if seconds else 0.,
+                          'bitsPerEvent': digits / events if events else 0.,
+                          'sourceEntropy': sourceEntropy, 'empiricalEntropy': empirical,
+                          'efficiency': digits / events / empirical if events and empirical else 0.}
+                if memory:
+                    result['peakMemory'] = peakMemory(modeName, data[:events])
+                # time growth exponent against the previous length: 1 is linear, 2 is quadratic
+                if curve and events > curve[-1]['events'] and curve[-1]['seconds'] and seconds:
+                    result['scaling'] = log(seconds / curve[-1]['seconds']) / log(events / curve[-1]['events'])
+                curve.append(result)
+                logging.info(f"{sourceName} {modeName} {events}: {result['eventsPerSecond']:.0f} events/s, {result['bitsPerEvent']:.3f} of {empirical:.3f} bits/event")
+            results.extend(curve)
+    return results
+
+
+def compare(results, old, tolerance):
+    '''
+    Print the changes against old results
+    return number of cases that got slower or less efficient than tolerance allows
+    '''
+    previous = {(r['source'], r['mode'], r['length']): r for r in old['results']}
+    regressions = 0
+    for r in results:
+        o = previous.get((r['source'], r['mode'], r['length']))
+        if o is None or not o['eventsPerSecond']:
+            continue
+        speed = r['eventsPerSecond'] / o['eventsPerSecond']
+        bits = r['bitsPerEvent'] - o['bitsPerEvent']
+        # lengths of truncated runs may differ, efficiency is comparable only for the same events
+        slower = speed < 1 - tolerance
+        worse = r['events'] == o['events'] and bits < -tolerance * o['bitsPerEvent']
+        regressions += slower or worse
+        mark = ' REGRESSION' if slower or worse else ''
+        print(f"{r['source']:15} {r['mode']:11} {r['length']:7} speed x{speed:.2f} bits/event {bits:+.4f}{mark}")
+    return regressions
+
+
+def parseFlags(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the extractor modes on seeded synthetic sources")
+    parser.add_argument('--verbose', '-v', action="count", default=0)
+    parser.add_argument('-l', '--lengths', help="Stream lengths. Default 250 1000 4000",
+                        nargs='+', type=int, default=[250, 1000, 4000])
+    parser.add_argument('-s', '--sources', help="Default all", nargs='+',
+                        choices=list(sources), default=list(sources))
+    parser.add_argument('-m', '--modes', help="Default all", nargs='+',
+                        choices=list(modes), default=list(modes))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--budget', help="Stop a case after this amount of seconds, the case is marked as truncated. 0 is off. Default 30",
+                        type=float, default=30.)
+    parser.add_argument('-r', '--repeat', help="Time every case this number of times and keep the fastest. Default 1",
+                        type=int, default=1)
+    parser.add_argument('--no-memory', help="Skip the peak memory run of every case. It is a separate run under tracemalloc",
+                        action='store_true')
+    parser.add_argument('-o', '--output', help="Write JSON results to file", default=None)
+    parser.add_argument('--compare', help="Compare results with this JSON results file. Exit code is 1 if any case regressed",
+                        default=None)
+    parser.add_argument('--tolerance', help="Relative slowdown or efficiency loss tolerated by --compare. Default 0.2",
+                        type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseFlags(argv)
+    logging.basicConfig(level=max(logging.WARNING - 10 * args.verbose, logging.DEBUG))
+    results = bench(args.sources, args.modes, sorted(args.lengths),
+                    args.seed, args.budget, not args.no_memory, args.repeat)
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'seed': args.seed, 'repeat': args.repeat,
+              'lengths': sorted(args.lengths), 'budget': args.budget, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f), args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,37 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import logging
-from math import log
+from math import log, log10, lcm, floor, isfinite
 from collections.abc import Iterable
 from collections.abc import Iterator
+from collections.abc import MutableMapping
 from fractions import Fraction as fr
+from bisect import bisect_left, bisect_right, insort
+from time import perf_counter, monotonic
 import pickle
+import json
+import os
+import sys
+import struct
+import mmap
+import multiprocessing
+import queue
+import selectors
+import stat
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from collections import deque, Counter
+from zlib import crc32
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 verbosity = 0
+# Tracer of the hot path. None is off, see setTracer()
+tracer = None
 
 
 def parseFlags():
@@ -15,7 +39,7 @@ def parseFlags():
     parser.add_argument(
         '--verbose', '-v', help="Enable verbose output of code execution. Needed for debug only. INFO level is -vvv", action="count", default=0)
     parser.add_argument(
-        '-i', '--input', help="Process information from file", default=None, type=str)
+        '-i', '--input', help="Process information from file. Repeat to extract several sources at once, each with own statistics, into one output. Source with data is processed without waiting for the others. '-' is stdin then", default=None, type=str, action='append')
     parser.add_argument(
         '-o', '--output', help="Send output to file", default=None, type=str)
     parser.add_argument(
@@ -27,14 +51,68 @@ def parseFlags():
     parser.add_argument(
         '-p', '--post-recalc', help="Recalculate probabilities after storing input: new items are treated to have 0 probability. Useful for dealing with non-comparable items (flag works, but non-comparable is TODO, not implemented)", action='store_true', default=False)
     parser.add_argument(
-        '-s', '--save-stats', help="Save input to this file to reuse this statistics later", type=str, default=None)
+        '-s', '--save-stats', help="Save input to this file to reuse this statistics later. Inserted events are appended to the [SAVE_STATS].journal file which is compacted into the snapshot from time to time", type=str, default=None)
     parser.add_argument(
-        '-l', '--load-stats', help="Load statistics of input from this file to get a jump-start. Could be same as in the --save-stats flag", type=str, default=None)
+        '-l', '--load-stats', help="Load statistics of input from this file to get a jump-start. Could be same as in the --save-stats flag. Counts are loaded into the --storage type", type=str, default=None)
     parser.add_argument('-r', '--round', help="Round. Allow this amount of bits to be lost here and there. Assumed to be 0..1. Lower values would result in more information output but would lead to use of bigger integer numbers in the code. Bigger numbers are a bad thing when overflow is to be considered. Zero and negative turn this flag off and probably lead to bad things (default)", type=float, default=-1)
     parser.add_argument('-c', '--convert', help="Use other method to process string input instead of float. 'none' is synonim to 'str' when working in the command line",
                         type=str, choices=['int', 'str', 'none', 'float'], default='float')
     parser.add_argument('-f', "--fixed", help="This argument will block insertions to Extractor.storage and predefine probabilities if value is provided. Example syntax: '7/22' - this will set p(0)=fr(7,22), p(1)=1-p(0). Only 0-1 input is supported with this flag. Setting '-c int' is recommended. Not properly tested",
                         nargs='?', default=None, const='', type=str)
+    parser.add_argument('--storage', help="Storage of input statistics. 'dict' is a plain dictionary that is scanned for every event. 'fenwick' keeps keys sorted with Fenwick trees of counts: every event costs O(log n), which pays off for sources with many distinct values. 'dense' is an array of counts for integer events 0..65535 (bytes, 16-bit samples) with a Fenwick tree on top: O(log k) per event and 16 bytes of memory per value up to the largest one seen (1 MB for 16-bit samples). An event out of its range moves the counts to 'dict' with a warning. 'auto' is dense for u8 and u16le --input-format or bins of --quantize and dict otherwise (default). Ignored for string input",
+                        type=str, choices=['auto', 'dict', 'fenwick', 'dense'], default='auto')
+    parser.add_argument('--engine', help="Interval arithmetic. 'exact' uses unbounded fractions. 'range32' and 'range64' keep the interval in fixed-width integers like a range coder: constant cost per event at the price of some lost entropy which is reported at INFO level",
+                        type=str, choices=['exact', 'range32', 'range64'], default='exact')
+    parser.add_argument('--max-fraction-bits', help="Soft reset when numerator or denominator of the interval grows longer than this number of bits. Hard ceiling on the cost of the fraction maths in long-running feeds. Checked after every batch of --batch. Zero is 16384 bits for batches and off for single events (default)",
+                        type=int, default=0)
+    parser.add_argument('--max-event-us', help="Soft reset when processing of an event takes longer than this number of microseconds. Zero turns this flag off (default)",
+                        type=float, default=0)
+    parser.add_argument('--compact-events', help="Compact the --save-stats journal into the snapshot after this number of events. Default 10000", type=int, default=10000)
+    parser.add_argument('--compact-seconds', help="Compact the --save-stats journal into the snapshot after this number of seconds. Zero turns this flag off (default)",
+                        type=float, default=0)
+    parser.add_argument('--checkpoint', help="Write the whole extractor state to this file in a compact binary format when input is over. Resume with --restore", type=str, default=None)
+    parser.add_argument('--checkpoint-events', help="Also write the --checkpoint file every this number of events, after their output is flushed. Resume with --restore on the input that follows these events. Binary output bits short of a whole byte are not kept. Zero turns this flag off (default)",
+                        type=int, default=0)
+    parser.add_argument('--input-format', help="Format of input. 'text' is one event per line. Others are raw little-endian binary records read without any parsing: u8, u16le and u32le are unsigned integers, f32le and f64le are floats. Partial record at the end of input is dropped",
+                        type=str, choices=['text'] + list(RecordReader.formats), default='text')
+    parser.add_argument('--output-format', help="Format of output. 'text' is a character per digit. 'binary' packs digits into raw bytes, most significant bit first, and needs a power of two base. Bits short of a whole byte at the end of output are dropped",
+                        type=str, choices=['text', 'binary'], default='text')
+    parser.add_argument('--flush-bytes', help="Flush output when at least this number of bytes is buffered", type=int, default=0)
+    parser.add_argument('--flush-events', help="Flush output when at least this number of events with output is buffered", type=int, default=0)
+    parser.add_argument('--flush-ms', help="Flush output when at least this number of milliseconds passed since the last flush. Checked when output is produced. If flush flags are set together then the first one to occur will be executed. All zeros flush output every event (default)",
+                        type=float, default=0)
+    parser.add_argument('--batch', help="Process input in batches of this number of events. Output is the same but it waits for the whole batch, and the --max-fraction-bits soft reset comes after the batch. Pays off most with --fixed probabilities. Default 1",
+                        type=int, default=1)
+    parser.add_argument('--trace', help="Write JSON lines of the hot path trace points to this file, '-' is stderr. Replaces the old -vvvv dumps and costs nothing when off", type=str, default=None)
+    parser.add_argument('--trace-points', help="Comma separated trace points to write: next2, next, feed, getProbs, numOfNewBits, approximation, insert, release, softReset, budget, entropy. Default is all of them", type=str, default=None)
+    parser.add_argument('--trace-every', help="Trace only every this number of events. Default 1", type=int, default=1)
+    parser.add_argument('--metrics-file', help="Write snapshots of the extractor metrics (events, digits, time per stage, soft resets, fraction sizes, latency) to this file periodically and when input is over", type=str, default=None)
+    parser.add_argument('--metrics-format', help="Format of --metrics-file: Prometheus text (default) or JSON",
+                        type=str, choices=['prometheus', 'json'], default='prometheus')
+    parser.add_argument('--metrics-seconds', help="Period of --metrics-file snapshots in seconds. Default 10", type=float, default=10)
+    parser.add_argument('--workers', help="Split input into this number of substreams, each extracted with own statistics in a worker process. Output of every round of workers*max(batch, 1024) events is the output of worker 0, then of worker 1 and so on, so it is reproducible for the same input, --workers, --shard and --batch. --save-stats files get the worker number suffix. Default 0 is off",
+                        type=int, default=0)
+    parser.add_argument('--shard', help="Split of input between workers: round robin (default) or by hash of the event, so that equal events go to the same worker",
+                        type=str, choices=['roundrobin', 'hash'], default='roundrobin')
+    parser.add_argument('--block-size', help="Cut input into blocks of this number of events and extract them independently in a pool of --workers processes (all cores when not set) with probabilities frozen per block. Output of every block is written in order. Fractions are bounded by the block. Default 0 is off",
+                        type=int, default=0)
+    parser.add_argument('--block-stats', help="Probabilities of a --block-size block: counts of the block itself (default) or counts of the input before the block, --load-stats included. The first block uses own counts then",
+                        type=str, choices=['own', 'previous'], default='own')
+    parser.add_argument('--quantize', help="Turn numbers into integer bins before they are counted, so that a continuous source does not make a new key of every event: 'step:X' is a grid of step X, 'sig:N' keeps N significant digits, 'bins:N:W' makes N bins of equal frequency out of the first W events, which are not extracted",
+                        type=str, default=None)
+    parser.add_argument('--window', help="Keep statistics of about this number of the last events only, so that memory is bounded and the extractor follows input distribution drift. Old events are forgotten at soft resets, which are made for it. 0 is off (default)",
+                        type=int, default=0)
+    parser.add_argument('--decay', help="Halve all the counts every this number of events, at a soft reset. Alternative to --window that keeps no events. 0 is off (default)",
+                        type=int, default=0)
+    parser.add_argument('--max-keys', help="Evict the rarest events when statistics have more distinct events than this, at a soft reset. 0 is off (default)",
+                        type=int, default=0)
+    parser.add_argument('command', help="'serve' runs the extractor as a service of random bytes over --unix and/or --tcp sockets instead of writing output, see EntropyService",
+                        nargs='?', choices=['serve'], default=None)
+    parser.add_argument('--unix', help="Unix socket path of the serve command", type=str, default=None)
+    parser.add_argument('--tcp', help="[HOST:]PORT of the serve command. Host is 127.0.0.1 when not given", type=str, default=None)
+    parser.add_argument('--pool-bytes', help="Bytes of output the serve command keeps ready for clients. Extraction waits when the pool is full. Default 1048576",
+                        type=int, default=1 << 20)
+    parser.add_argument('--restore', help="Resume from the state saved with --checkpoint. Could be same as in the --checkpoint flag", type=str, default=None)
     return parser.parse_args()
 
 
@@ -50,6 +128,143 @@ def setLogger(lvl, **kwargs):
     logging.debug(f"Setting logger debug {lvl}, {ll}, {lls}, {kwargs}")
 
 
+class Tracer():
+    '''
+    Structured trace of the hot path: every trace point writes a JSON line with its name, event number, time in seconds and the fields of the point.
+    Trace points are guarded by the module global: if tracer and tracer.wants('point'): tracer.emit('point', ...) so nothing is formatted when tracing is off
+    Points: next2, next, feed, getProbs, numOfNewBits, approximation, insert, release, softReset, budget, entropy
+    points  -   trace only these points. None is all of them
+    sample  -   trace only every sample-th event
+    closeAtEnd  -   close outp in close()
+    '''
+
+    def __init__(self, outp, points: Iterable = None, sample: int = 1, closeAtEnd: bool = False):
+        self.outp = outp
+        self.closeAtEnd = closeAtEnd
+        self.points = set(points) if points else None
+        self.sample = max(1, sample)
+        self.events = 0
+        self.started = perf_counter()
+
+    def tick(self, events: int = 1):
+        ''' Count processed events for the sampling
+        '''
+        self.events += events
+
+    def wants(self, point: str):
+        return (self.events - 1) % self.sample == 0 and (self.points is None or point in self.points)
+
+    def emit(self, point: str, **fields):
+        record = {'point': point, 'event': self.events,
+                  'time': round(perf_counter() - self.started, 6)}
+        record.update(fields)
+        # Fractions and storages are written as strings
+        self.outp.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        if self.closeAtEnd:
+            self.outp.close()
+
+
+def setTracer(fname: str = None, points: Iterable = None, sample: int = 1):
+    '''
+    Turn tracing on to fname ('-' is stderr) or off if fname is None. See Tracer
+    '''
+    global tracer
+    if tracer:
+        tracer.close()
+    tracer = None
+    if fname == '-':
+        tracer = Tracer(sys.stderr, points, sample)
+    elif fname:
+        tracer = Tracer(open(fname, 'w', buffering=1),
+                        points, sample, closeAtEnd=True)
+    return tracer
+
+
+class Metrics():
+    '''
+    Counters and timers of an Extractor, see Extractor.metrics()
+    Time is summed up per stage: probs (storage update and probabilities), interval (interval update), approximation (digit search and rev-mode checks) and io (loop() reading and writing)
+    Latency is the time from the arrival of the oldest event without output to the output
+    '''
+    stages = ('probs', 'interval', 'approximation', 'io')
+    # name, type and help of the Prometheus metrics made from Extractor.metrics()
+    prometheusNames = {'events': ('mrge_events_total', 'counter', 'Events processed'),
+                       'digits': ('mrge_digits_total', 'counter', 'Output digits emitted'),
+                       'digitsPerEvent': ('mrge_digits_per_event', 'gauge', 'Output digits per event'),
+                       'entropyPerEvent': ('mrge_entropy_per_event', 'gauge', 'Theoretical entropy of the storage per event in digits'),
+                       'seconds': ('mrge_stage_seconds_total', 'counter', 'Time spent per stage'),
+                       'softResets': ('mrge_soft_resets_total', 'counter', 'Soft resets done'),
+                       'lostEntropy': ('mrge_lost_entropy_digits_total', 'counter', 'Accumulated entropy not emitted at soft resets'),
+                       'fractionBits': ('mrge_fraction_bits', 'gauge', 'Bit length of the interval fractions'),
+                       'latency': ('mrge_latency_seconds', 'gauge', 'Time from event arrival to output'),
+                       'keys': ('mrge_storage_keys', 'gauge', 'Distinct events in storage')}
+
+    def __init__(self):
+        self.events = 0
+        self.digits = 0
+        self.softResets = 0
+        self.lostEntropy = 0.
+        self.seconds = dict.fromkeys(Metrics.stages, 0.)
+        self.pendingSince = None
+        self.emissions = 0
+        self.latencyLast = 0.
+        self.latencyMax = 0.
+        self.latencyTotal = 0.
+
+    def arrived(self, now: float, events: int = 1):
+        self.events += events
+        if self.pendingSince is None:
+            self.pendingSince = now
+
+    def emitted(self, digits: int, now: float):
+        self.digits += digits
+        self.emissions += 1
+        if self.pendingSince is not None:
+            self.latencyLast = now - self.pendingSince
+            self.latencyMax = max(self.latencyMax, self.latencyLast)
+            self.latencyTotal += self.latencyLast
+            self.pendingSince = None
+
+    @staticmethod
+    def prometheus(snapshot: dict):
+        ''' return snapshot of Extractor.metrics() in the Prometheus text format
+        '''
+        lines = []
+        # snapshots of the sources of a multi-input extractor get the source label
+        snapshots = [('', snapshot)]
+        for source, sourceSnapshot in snapshot.get('sources', {}).items():
+            escaped = source.replace('\\', '\\\\').replace('"', '\\"')
+            snapshots.append((f'source="{escaped}",', sourceSnapshot))
+        for key, (name, kind, description) in Metrics.prometheusNames.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for labels, values in snapshots:
+                value = values[key]
+                if isinstance(value, dict):
+                    label = {'seconds': 'stage', 'fractionBits': 'part',
+                             'latency': 'stat'}[key]
+                    lines += [f'{name}{{{labels}{label}="{part}"}} {number}' for part,
+                              number in value.items()]
+                elif labels:
+                    lines.append(f"{name}{{{labels[:-1]}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def write(fname: str, snapshot: dict, metricsFormat: str = 'prometheus'):
+        ''' Replace fname atomically with the snapshot in 'prometheus' or 'json' format
+        '''
+        tmpName = fname + '.tmp'
+        with open(tmpName, 'w') as outFile:
+            if metricsFormat == 'json':
+                json.dump(snapshot, outFile)
+            else:
+                outFile.write(Metrics.prometheus(snapshot))
+        os.replace(tmpName, fname)
+
+
 def parseFixedArg(fixed: str):
     if fixed is None:
         return None
@@ -76,6 +291,8 @@ def init():
     args = parseFlags()
     verbosity = args.verbose
     setLogger(verbosity)
+    setTracer(args.trace, args.trace_points.split(',')
+              if args.trace_points else None, args.trace_every)
     # Ugly. Can you do better?:
     str2cmp = {'int': int, 'str': str,
                'none': str, 'float': float}[args.convert]
@@ -84,41 +301,268 @@ def init():
         logging.error(
             f"Flags mismatch detected: --fixed is set but --load-stats is not. The code will run but no output is expected. Duh")
     eFlags = {'base': args.base, 'preNotPostRecalc': not args.post_recalc, 'revBlock': args.rev_block, 'revEntropy': args.rev_entropy,
-              'saveStats': args.save_stats, 'loadStats': args.load_stats, 'inp': args.input, 'outp': args.output, 'rounding': args.round, 'str2cmp': str2cmp, 'fixed': fixed}
+              'saveStats': args.save_stats, 'loadStats': args.load_stats, 'inp': args.input, 'outp': args.output, 'rounding': args.round, 'str2cmp': str2cmp, 'fixed': fixed, 'storageType': args.storage, 'engine': args.engine, 'maxFractionBits': args.max_fraction_bits, 'maxEventUs': args.max_event_us, 'compactEvents': args.compact_events, 'compactSeconds': args.compact_seconds, 'checkpointFName': args.checkpoint, 'checkpointEvents': args.checkpoint_events, 'restoreFName': args.restore, 'inputFormat': args.input_format, 'outputFormat': args.output_format, 'flushBytes': args.flush_bytes, 'flushEvents': args.flush_events, 'flushMs': args.flush_ms, 'batchSize': args.batch, 'metricsFName': args.metrics_file, 'metricsFormat': args.metrics_format, 'metricsSeconds': args.metrics_seconds, 'workers': args.workers, 'shard': args.shard, 'blockSize': args.block_size, 'blockStats': args.block_stats, 'window': args.window, 'decay': args.decay, 'maxKeys': args.max_keys, 'quantize': args.quantize}
+    eFlags['service'] = None
+    if args.command == 'serve':
+        assert args.unix or args.tcp, "serve needs --unix or --tcp"
+        eFlags['service'] = {'unixPath': args.unix,
+                             'tcp': args.tcp, 'poolBytes': args.pool_bytes}
     logging.debug(f"Argument space is {args}\n{eFlags}")
     return eFlags
 
 
+class ChunkReader(Iterator):
+    '''
+    Lazy iterator over the events of a binary stream. Reads in big chunks, so memory does not depend on the stream length. Iteration stops on EOF only
+    Subclasses define split(chunk) -> (events, unfinished tail) and finish(tail) -> events
+    '''
+    chunkSize = 1 << 20
+
+    def __init__(self, source, chunkSize: int = 0, closeAtEnd: bool = False):
+        '''
+        source  -   binary file object. read1() is used when available so that interactive streams yield events as soon as they arrive
+        closeAtEnd  -   close source on EOF
+        '''
+        self.source = source
+        self.read = getattr(source, 'read1', source.read)
+        self.chunkSize = chunkSize or ChunkReader.chunkSize
+        self.closeAtEnd = closeAtEnd
+        self.events = iter(())
+        self.tail = b''
+
+    def __next__(self):
+        while True:
+            for event in self.events:
+                return event
+            if self.source is None:
+                raise StopIteration()
+            self.events = iter(self.readEvents())
+
+    def readEvents(self):
+        '''
+        Read the source once. source is None after EOF
+        return events of the read
+        '''
+        chunk = self.read(self.chunkSize)
+        if chunk:
+            events, self.tail = self.split(self.tail + chunk)
+            return events
+        events = self.finish(self.tail)
+        self.tail = b''
+        if self.closeAtEnd:
+            self.source.close()
+        self.source = None
+        return events
+
+
+class LineReader(ChunkReader):
+    '''
+    Text lines of a stream. Lines are stripped, blank lines are skipped
+    '''
+
+    def split(self, chunk):
+        # newline byte never occurs inside of a multibyte utf-8 character
+        cut = chunk.rfind(b'\n') + 1
+        return self.finish(chunk[:cut]), chunk[cut:]
+
+    def finish(self, tail):
+        # last line may come without newline
+        return [line for line in map(str.strip, tail.decode().split('\n')) if line]
+
+
+class RecordReader(ChunkReader):
+    '''
+    Fixed-width little-endian binary records of a raw sample stream, see RecordReader.formats. No parsing: chunks are copied to an array as they are
+    '''
+    formats = {'u8': 'B', 'u16le': 'H', 'u32le': 'I', 'f32le': 'f', 'f64le': 'd'}
+
+    def __init__(self, source, inputFormat: str, chunkSize: int = 0, closeAtEnd: bool = False):
+        super().__init__(source, chunkSize, closeAtEnd)
+        self.typecode = RecordReader.formats[inputFormat]
+        self.itemsize = array(self.typecode).itemsize
+
+    def split(self, chunk):
+        view = memoryview(chunk)
+        cut = len(view) - len(view) % self.itemsize
+        records = array(self.typecode)
+        records.frombytes(view[:cut])
+        if sys.byteorder == 'big':
+            records.byteswap()
+        return records.tolist(), bytes(view[cut:])
+
+    def finish(self, tail):
+        if tail:
+            logging.warning(
+                f"Input ended with a partial record of {len(tail)} bytes. It is dropped")
+        return []
+
+
+class OutputWriter():
+    '''
+    Buffered writer of output digits with a flush policy
+    'text' writes a character per digit. 'binary' packs digits of a power-of-two base into raw bytes, most significant bit first. Bits short of a whole byte at the end of output are dropped
+    Buffer is flushed to the output when any of flushBytes, flushEvents or flushMs is reached (0 is off). Time is checked when digits are written. All zeros flush every event
+    '''
+
+    def __init__(self, outp, base: int = 2, outputFormat: str = 'text', flushBytes: int = 0, flushEvents: int = 0, flushMs: float = 0):
+        self.binary = outputFormat == 'binary'
+        if self.binary:
+            assert base & (base - 1) == 0, "Binary output needs a power of two base"
+            # text output wrapper is skipped for raw bytes
+            outp = getattr(outp, 'buffer', outp)
+        self.outp = outp
+        self.digitBits = base.bit_length() - 1
+        self.flushBytes = flushBytes
+        self.flushEvents = flushEvents
+        self.flushMs = flushMs
+        self.buffer = []
+        self.bufferedBytes = 0
+        self.bufferedEvents = 0
+        self.flushed = monotonic()
+        self.bits = 0
+        self.bitsCount = 0
+
+    def write(self, digits):
+        if self.binary:
+            for digit in digits:
+                self.bits = self.bits << self.digitBits | digit
+            self.bitsCount += self.digitBits * len(digits)
+            nBytes = self.bitsCount // 8
+            if not nBytes:
+                return
+            self.bitsCount -= 8 * nBytes
+            chunk = (self.bits >> self.bitsCount).to_bytes(nBytes, 'big')
+            self.bits &= (1 << self.bitsCount) - 1
+        else:
+            chunk = ''.join(map(str, digits))
+            if verbosity > 3:
+                chunk = '>> ' + chunk + '\n'
+        self.buffer.append(chunk)
+        self.bufferedBytes += len(chunk)
+        self.bufferedEvents += 1
+        if not (self.flushBytes or self.flushEvents or self.flushMs) or \
+                self.flushBytes and self.bufferedBytes >= self.flushBytes or \
+                self.flushEvents and self.bufferedEvents >= self.flushEvents or \
+                self.flushMs and (monotonic() - self.flushed) * 1000 >= self.flushMs:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.outp.write((b'' if self.binary else '').join(self.buffer))
+            self.buffer = []
+        self.outp.flush()
+        self.bufferedBytes = 0
+        self.bufferedEvents = 0
+        self.flushed = monotonic()
+
+    def close(self):
+        ''' flush the buffer. Output itself is left open
+        '''
+        if self.bitsCount:
+            logging.info(
+                f"{self.bitsCount} bits short of a whole byte are dropped from output")
+            self.bits = self.bitsCount = 0
+        self.flush()
+
+
 # Make an iterator from stdin
-class ISIterator(Iterator):
+class ISIterator(LineReader):
     def __init__(self):
         from sys import stdin
-        self.sin = stdin
+        super().__init__(stdin.buffer)
 
-    def __next__(self):
-        inl = self.sin.readline().strip()
-        if inl:
-            return inl
-        raise StopIteration()
+
+def xlogx(x):
+    return x*log(x) if x > 0 else 0.
 
 
-class DictionaryEnumerator(dict):
+class EventCounter():
+    '''
+    Running totals for storages: number of events and sum of n*ln(n) over the counts.
+    Storages call recount() on every change of a count, so that total number of events and theoretical entropy are O(1) reads
+    '''
+
+    def resetCounters(self):
+        self.total = 0
+        self.nlogn = 0.
+
+    def countTotals(self, counts):
+        ''' Running totals of all the counts at once. Equal counts are summed up together, there are few distinct ones in a big storage
+        '''
+        self.total = sum(counts)
+        self.nlogn = sum(n * xlogx(count) for count, n in Counter(counts).items())
+
+    def recount(self, old, new):
+        self.total += new - old
+        self.nlogn += xlogx(new) - xlogx(old)
+
+    def entropy(self, base=2):
+        ''' Theoretical entropy of the stored events: sum of -n*log(n/total) in given base
+        '''
+        if len(self) < 2:
+            return 0
+        # running sums may drift by an ulp or so. Entropy is never negative
+        return max(0., (xlogx(self.total) - self.nlogn)/log(base))
+
+
+class DictionaryEnumerator(EventCounter, dict):
     '''
     This is a class to allow mrge to operate over any items, not only the ones with defined compare operation
+    Items get increasing integer ids in the order of arrival and are compared by them. Counts live in an array indexed by id with a Fenwick tree of them on top,
+    so both probabilities of an item are O(log n). Ids of deleted items are dropped by renumbering once there are as many of them as of the live ones
     '''
+    # ids are not renumbered while the array is this small
+    compactSlack = 1024
 
     def __init__(self):
-        self.id = 0
-        self.lookup = {}
-        self.count = {}
+        self.build({}, array('Q'))
+
+    def build(self, lookup: dict, counts: array):
+        ''' Fill with lookup of item to id and counts indexed by id
+        '''
+        self.lookup = lookup
+        self.counts = counts
+        self.tree = FenwickTree(counts, 'Q')
+        self.countTotals(counts)
+
+    @property
+    def id(self):
+        ''' The id the next new item gets
+        '''
+        return len(self.counts)
+
+    def __reduce__(self):
+        # default dict pickling would replay items() into __setitem__
+        return (self.__class__, (), {'lookup': self.lookup, 'counts': self.counts})
+
+    def __setstate__(self, state):
+        if 'count' in state:
+            # pickled by the versions with a dictionary of counts
+            counts = array('Q', bytes(8 * state['id']))
+            for itemid, count in state['count'].items():
+                counts[itemid] = count or 0
+            state = {'lookup': state['lookup'], 'counts': counts}
+        self.build(state['lookup'], state['counts'])
 
     def __contains__(self, *ar, **kw):
         return self.lookup.__contains__(*ar, **kw)
 
-    def __delitem__(self, *ark, **kw):
-        # Not sure if it is a nice thing to do, but
-        self.count.__delitem__(self.lookup(ark[0]))
-        return self.lookup.__delitem__(*ark, **kw)
+    def __delitem__(self, key):
+        itemid = self.lookup.pop(key)
+        count = self.counts[itemid]
+        self.recount(count, 0)
+        self.counts[itemid] = 0
+        self.tree.add(itemid, -count)
+        if len(self.counts) >= 2 * len(self.lookup) + self.compactSlack:
+            self.renumber()
+
+    def renumber(self):
+        ''' Give the items ids 0..len-1 in the order of the old ones, so that the arrays have no slots of deleted items
+        '''
+        order = sorted(self.lookup.items(), key=lambda pair: pair[1])
+        self.lookup = {item: i for i, (item, _) in enumerate(order)}
+        self.counts = array('Q', (self.counts[itemid] for _, itemid in order))
+        self.tree.rebuild(self.counts)
 
     def __repr__(self):
         items = list((x, self.__getitem__(x)) for x in self.lookup.keys())
@@ -127,12 +571,12 @@ class DictionaryEnumerator(dict):
 
     # Trez importance
     def __getitem__(self, item):
-        return self.count.__getitem__(self.lookup.__getitem__(item))
+        return self.counts[self.lookup[item]]
 
     def __eq__(self, value):
         if type(self) != type(value):
             return False
-        return self.lookup == value.lookup and self.count == value.count
+        return self.lookup == value.lookup and self.values() == value.values()
 
     def __iter__(self):
         # Not tested. Not trusted
@@ -151,39 +595,48 @@ class DictionaryEnumerator(dict):
 
     def __setitem__(self, item, value):
      # This is the main method, basically
-        itemid = self.lookup.setdefault(item, self.id)
-        if itemid == self.id:
-            self.id += 1
-        self.count[itemid] = value
+        itemid = self.lookup.get(item)
+        if itemid is None:
+            # one copy of the string for the lookup and all of the events
+            if type(item) == str:
+                item = sys.intern(item)
+            self.lookup[item] = len(self.counts)
+            self.counts.append(value)
+            self.tree.append(value)
+            self.recount(0, value)
+            return
+        old = self.counts[itemid]
+        self.recount(old, value)
+        self.counts[itemid] = value
+        self.tree.add(itemid, value - old)
 
     def __sizeof__(self):
-        # Not tested
-        return self.lookup.__sizeof__()+self.count.__sizeof__()+self.id.__sizeof__()
+        # keys are not counted, same as in sys.getsizeof of a dict
+        return object.__sizeof__(self) + self.lookup.__sizeof__() + self.counts.__sizeof__() + self.tree.tree.__sizeof__()
 
     def clear(self):
-        self.lookup.clear()
-        self.count.clear()
-        self.id = 0
+        self.build({}, array('Q'))
 
     def copy(self):
         cp = DictionaryEnumerator()
-        cp.id = self.id
-        cp.lookup = self.lookup.copy()
-        cp.count = self.count.copy()
+        cp.build(self.lookup.copy(), array('Q', self.counts))
         return cp
 
     def get(self, key, default=None):
-        return self.count.get(self.lookup.get(key), default)
+        itemid = self.lookup.get(key)
+        if itemid is None:
+            return default
+        return self.counts[itemid]
 
     def items(self):
         # Second meaningful and actualy useful method for the class
-        return {(intID, self.count[intID]) for intID in self.lookup.values()}
+        return [(itemid, self.counts[itemid]) for itemid in self.lookup.values()]
 
     def keys(self):
         return self.lookup.keys()
 
     def values(self):
-        return self.count.values()
+        return [self.counts[itemid] for itemid in self.lookup.values()]
 
     # def pop():
     # def popitem
@@ -191,24 +644,812 @@ class DictionaryEnumerator(dict):
     # def fromkeys
 
     def setdefault(self, key, default=None):
-        itemid = self.lookup.setdefault(key, self.id)
-        if self.id == itemid:
-            self.id += 1
-        return self.count.setdefault(itemid, default)
+        itemid = self.lookup.get(key)
+        if itemid is not None:
+            return self.counts[itemid]
+        # counts are integers, so no count is zero count
+        self[key] = default or 0
+        return self[key]
 
     def getID(self, key):
         return self.lookup[key]
 
+    def getProbs(self, item):
+        ''' Same as Extractor.getProbs(item, self). Items are compared by ids, an unknown item is bigger than all of them
+        '''
+        if self.total == 0:
+            return (0, 0)
+        itemid = self.lookup.get(item)
+        if itemid is None:
+            return (0, 1)
+        return fr(self.counts[itemid], self.total), fr(self.tree.prefix(itemid), self.total)
+
+
+class FenwickTree():
+    '''
+    Binary indexed tree over a list of counts. Point update and prefix sum are O(log n)
+    Tree is an array of this typecode if one is given
+    '''
+
+    def __init__(self, counts=(), typecode: str = None):
+        self.typecode = typecode
+        self.rebuild(counts)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def rebuild(self, counts):
+        tree = array(self.typecode, [0]) if self.typecode else [0]
+        tree.extend(counts)
+        size = len(tree)
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def values(self):
+        ''' Return the plain list of counts the tree is built from
+        '''
+        counts = self.tree[:]
+        size = len(counts)
+        for i in range(size - 1, 0, -1):
+            parent = i + (i & -i)
+            if parent < size:
+                counts[parent] -= counts[i]
+        return counts[1:]
+
+    def add(self, index, delta):
+        i = index + 1
+        size = len(self.tree)
+        while i < size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, index):
+        ''' Sum of the first index counts
+        '''
+        s = 0
+        while index > 0:
+            s += self.tree[index]
+            index &= index - 1
+        return s
+
+    def append(self, count):
+        ''' Add a position after the last one. O(log n): the new node sums the counts it covers
+        '''
+        i = len(self.tree)
+        self.tree.append(count + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def insert(self, index, count):
+        # O(n), used only when a new position appears in the middle
+        if index == len(self):
+            return self.append(count)
+        counts = self.values()
+        counts.insert(index, count)
+        self.rebuild(counts)
+
+    def remove(self, index):
+        ''' Drop the position, the later ones move down. O(n)
+        '''
+        counts = self.values()
+        del counts[index]
+        self.rebuild(counts)
+
+
+class CountingStorage(EventCounter, dict):
+    '''
+    The default storage: a dictionary of event counts that keeps running totals, see EventCounter
+    '''
+
+    def __init__(self, *args, **kwargs):
+        # filled in bulk, so that restore and unpickling of a big storage do not go key by key
+        dict.__init__(self, *args, **kwargs)
+        self.countTotals(dict.values(self))
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __setitem__(self, key, value):
+        self.recount(dict.get(self, key, 0), value)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.recount(dict.__getitem__(self, key), 0)
+        dict.__delitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return dict.__getitem__(self, key)
+        self[key] = default
+        return default
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        dict.__setitem__(self, key, value)
+        del self[key]
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self.resetCounters()
+
+    def copy(self):
+        return self.__class__(self)
+
+
+class FenwickStorage(CountingStorage):
+    '''
+    Drop-in replacement for the storage dictionary that keeps its keys ordered.
+    Keys are kept in sorted blocks with a Fenwick tree of block counts on top and a Fenwick tree of the key counts in every block, so point probability, less-than probability and count update are O(log n) instead of a scan over the whole storage.
+    A new key is inserted into its block in O(blockSize). A block that grows over 2*blockSize keys is split, which rebuilds the tree of blocks once per blockSize new keys
+    Keys have to be mutually comparable
+    '''
+    blockSize = 64
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.build(dict(*args, **kwargs))
+
+    def build(self, counts):
+        dict.clear(self)
+        dict.update(self, counts)
+        self.countTotals(counts.values())
+        keys = sorted(counts)
+        self.blocks = [keys[i:i+self.blockSize]
+                       for i in range(0, len(keys), self.blockSize)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.blockTrees = [FenwickTree(map(counts.__getitem__, block))
+                           for block in self.blocks]
+        self.tree = FenwickTree(sum(map(counts.__getitem__, block))
+                                for block in self.blocks)
+
+    def __repr__(self):
+        return f"FS_{dict.__repr__(self)}_FS"
+
+    def blockOf(self, key):
+        b = bisect_left(self.maxes, key)
+        if b == len(self.maxes):
+            return b - 1
+        return b
+
+    def addKey(self, key):
+        ''' New key of zero count
+        '''
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            self.blockTrees.append(FenwickTree([0]))
+            self.tree.append(0)
+            return
+        b = self.blockOf(key)
+        block = self.blocks[b]
+        pos = bisect_left(block, key)
+        block.insert(pos, key)
+        self.blockTrees[b].insert(pos, 0)
+        self.maxes[b] = block[-1]
+        if len(block) > 2*self.blockSize:
+            # split the block in halves and move the count of the upper half to the new tree node
+            upper = block[self.blockSize:]
+            del block[self.blockSize:]
+            self.blocks.insert(b+1, upper)
+            self.maxes[b] = block[-1]
+            self.maxes.insert(b+1, upper[-1])
+            self.blockTrees[b] = FenwickTree(map(self.__getitem__, block))
+            self.blockTrees.insert(b+1, FenwickTree(map(self.__getitem__, upper)))
+            upperCount = sum(map(self.__getitem__, upper))
+            self.tree.add(b, -upperCount)
+            self.tree.insert(b+1, upperCount)
+
+    def removeKey(self, key):
+        ''' Drop the key of zero count
+        '''
+        b = self.blockOf(key)
+        block = self.blocks[b]
+        pos = bisect_left(block, key)
+        del block[pos]
+        if block:
+            self.maxes[b] = block[-1]
+            self.blockTrees[b].remove(pos)
+            return
+        del self.blocks[b]
+        del self.maxes[b]
+        del self.blockTrees[b]
+        self.tree.remove(b)
+
+    def __setitem__(self, key, value):
+        old = dict.get(self, key)
+        if old is None:
+            # zero count first so that a block split sees consistent counts
+            dict.__setitem__(self, key, 0)
+            self.addKey(key)
+            old = 0
+        b = self.blockOf(key)
+        self.blockTrees[b].add(bisect_left(self.blocks[b], key), value - old)
+        self.tree.add(b, value - old)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self[key] = 0
+        self.removeKey(key)
+        super().__delitem__(key)
+
+    def clear(self):
+        self.build({})
+
+    def lessThan(self, key):
+        ''' Number of events strictly smaller than key
+        '''
+        b = bisect_left(self.maxes, key)
+        if b == len(self.maxes):
+            return self.total
+        return self.tree.prefix(b) + self.blockTrees[b].prefix(bisect_left(self.blocks[b], key))
+
+    def getProbs(self, item):
+        ''' Same as Extractor.getProbs(item, self)
+        '''
+        if self.total == 0:
+            return (0, 0)
+        lessThanFrac = fr(self.lessThan(item), self.total)
+        count = self.get(item)
+        if count is None:
+            return (0, lessThanFrac)
+        return fr(count, self.total), lessThanFrac
+
+
+class DenseStorage(EventCounter, MutableMapping):
+    '''
+    Storage for small non-negative integer events (bytes, 16-bit samples): counts live in an array indexed by the event, with a Fenwick tree of them for the less-than probability.
+    Memory is 16 bytes per event value up to the largest one seen, in powers of two from 256 up to maxSize: 4 KB for bytes, 1 MB for 16-bit samples.
+    Extractor moves the counts to the dictionary storage when an event does not fit, see Extractor.insert
+    Like in collections.Counter, a missing event has zero count. Integral floats are stored as integers
+    '''
+    maxSize = 1 << 16
+
+    def __init__(self, counts=(), size: int = 256):
+        self.resetCounters()
+        self.counts = array('Q', bytes(8 * size))
+        self.tree = FenwickTree(self.counts, 'Q')
+        self.size = 0
+        self.update(counts)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), len(self.counts)))
+
+    def __repr__(self):
+        return f"DS_{dict(self)}_DS"
+
+    def slot(self, key):
+        ''' return index of key in self.counts or None if key can not be stored
+        '''
+        try:
+            index = int(key)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if index != key or not 0 <= index < self.maxSize:
+            return None
+        return index
+
+    def __getitem__(self, key):
+        index = self.slot(key)
+        if index is None or index >= len(self.counts):
+            return 0
+        return self.counts[index]
+
+    def __setitem__(self, key, value):
+        index = self.slot(key)
+        if index is None:
+            raise ValueError(
+                f"DenseStorage keeps integers 0..{self.maxSize-1} only, not {key!r}")
+        if index >= len(self.counts):
+            size = len(self.counts)
+            while size <= index:
+                size *= 2
+            self.counts.extend(bytes(8 * (size - len(self.counts))))
+            self.tree.rebuild(self.counts)
+        old = self.counts[index]
+        self.size += bool(value) - bool(old)
+        self.recount(old, value)
+        self.counts[index] = value
+        self.tree.add(index, value - old)
+
+    def __delitem__(self, key):
+        if not self[key]:
+            raise KeyError(key)
+        self[key] = 0
+
+    def __contains__(self, key):
+        return self[key] > 0
+
+    def __iter__(self):
+        return (index for index, count in enumerate(self.counts) if count)
+
+    def __len__(self):
+        return self.size
+
+    def get(self, key, default=None):
+        return self[key] or default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        if default:
+            self[key] = default
+        return default
+
+    def clear(self):
+        self.resetCounters()
+        self.counts = array('Q', bytes(len(self.counts) * 8))
+        self.tree.rebuild(self.counts)
+        self.size = 0
+
+    def copy(self):
+        return self.__class__(self, len(self.counts))
+
+    def lessThan(self, key):
+        ''' Number of events strictly smaller than key
+        '''
+        index = min(max(0, -int(-key // 1)), len(self.counts))
+        return self.tree.prefix(index)
+
+    def getProbs(self, item):
+        ''' Same as Extractor.getProbs(item, self)
+        '''
+        if self.total == 0:
+            return (0, 0)
+        lessThanFrac = fr(self.lessThan(item), self.total)
+        count = self[item]
+        if not count:
+            return (0, lessThanFrac)
+        return fr(count, self.total), lessThanFrac
+
+
+class StatsJournal():
+    '''
+    Keeps the --save-stats file up to date without re-pickling the whole storage on every insertion.
+    The file is a snapshot: pickled storage followed by a pickled token and a pickled dictionary of extra() (quantizer edges). Inserted items are appended to the fname.journal file, which starts with the token of its snapshot.
+    Journal is compacted into a new snapshot every compactEvents events or compactSeconds seconds and whenever the storage object is replaced
+    '''
+    suffix = '.journal'
+
+    def __init__(self, fname: str, compactEvents: int = 10000, compactSeconds: float = 0):
+        self.fname = fname
+        self.compactEvents = compactEvents
+        self.compactSeconds = compactSeconds
+        # The storage object the last snapshot was taken from
+        self.storage = None
+        self.journal = None
+        self.journaled = 0
+        self.compacted = monotonic()
+        # data saved along with the storage, see load()
+        self.extra = dict
+
+    def record(self, storage, items):
+        ''' Save items that have just been inserted to the storage
+        '''
+        if storage is not self.storage or \
+                (self.compactEvents and self.journaled >= self.compactEvents) or \
+                (self.compactSeconds and monotonic() - self.compacted >= self.compactSeconds):
+            self.compact(storage)
+            return
+        pickle.dump(items, self.journal)
+        self.journal.flush()
+        self.journaled += len(items)
+
+    def compact(self, storage):
+        token = os.urandom(8)
+        # Snapshot is replaced atomically. A crash before the journal restart leaves a journal with a stale token that is not replayed
+        tmpName = self.fname + '.tmp'
+        with open(tmpName, 'wb') as outFile:
+            # counting storages are saved as plain dictionaries, so that the file does not refer to the module it was made by (__main__ of the script)
+            pickle.dump(dict(storage) if isinstance(storage, (CountingStorage, DenseStorage)) else storage, outFile)
+            pickle.dump(token, outFile)
+            pickle.dump(self.extra(), outFile)
+        os.replace(tmpName, self.fname)
+        if self.journal:
+            self.journal.close()
+        self.journal = open(self.fname + self.suffix, 'wb')
+        pickle.dump(token, self.journal)
+        self.journal.flush()
+        self.storage = storage
+        self.journaled = 0
+        self.compacted = monotonic()
+
+    def close(self):
+        if self.storage is not None:
+            self.compact(self.storage)
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    @staticmethod
+    def load(fname, extra: dict = None):
+        '''
+        return the storage from the snapshot with the journal tail replayed. Plain pickled storages are fine too
+        extra dictionary is updated with the data saved along with the storage
+        '''
+        with open(fname, 'rb') as infile:
+            storage = pickle.load(infile)
+            try:
+                token = pickle.load(infile)
+            except EOFError:
+                return storage
+            try:
+                if extra is not None:
+                    extra.update(pickle.load(infile))
+            except EOFError:
+                # older snapshots have no extra data
+                pass
+        try:
+            journal = open(fname + StatsJournal.suffix, 'rb')
+        except FileNotFoundError:
+            return storage
+        with journal:
+            try:
+                if pickle.load(journal) != token:
+                    return storage
+                while True:
+                    for item in pickle.load(journal):
+                        if item is None:
+                            continue
+                        storage.setdefault(item, 0)
+                        storage[item] += 1
+            except (EOFError, pickle.UnpicklingError):
+                # end of journal or a record cut by a crash
+                pass
+        return storage
+
+
+class Checkpoint():
+    '''
+    Versioned binary layout of the whole extractor state, see Extractor.checkpoint() and Extractor.restore()
+    File is the magic, u16 version and a sequence of sections: 4-byte tag, u64 payload length, payload. Payload is a list of chunks, each one is u64 length and bytes. All numbers are little-endian
+    Keys and counts are plain arrays, so they are read straight out of the memory-mapped file. Unknown sections are skipped
+    Use as a context manager to read: with Checkpoint(fname) as sections: ...
+    '''
+    magic = b'MRGECKPT'
+    version = 1
+    header = struct.Struct('<8sH')
+    sectionHeader = struct.Struct('<4sQ')
+    chunkHeader = struct.Struct('<Q')
+
+    def __init__(self, fname: str):
+        self.fname = fname
+
+    def __enter__(self):
+        self.file = open(self.fname, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version = Checkpoint.header.unpack_from(self.view)
+        if magic != Checkpoint.magic:
+            raise ValueError(f"{self.fname} is not a checkpoint")
+        if version > Checkpoint.version:
+            raise ValueError(
+                f"Checkpoint {self.fname} version {version} is newer than supported {Checkpoint.version}")
+        self.sections = {}
+        offset = Checkpoint.header.size
+        while offset < len(self.view):
+            tag, length = Checkpoint.sectionHeader.unpack_from(
+                self.view, offset)
+            offset += Checkpoint.sectionHeader.size
+            self.sections[tag] = Checkpoint.unpackChunks(
+                self.view[offset:offset+length])
+            offset += length
+        return self.sections
+
+    def __exit__(self, *exc):
+        self.sections = None
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # a chunk is still referenced from a traceback. The map is closed when it is gone
+            pass
+        self.file.close()
+
+    @staticmethod
+    def write(fname: str, sections: dict):
+        ''' sections is {tag: list of chunks}. File is replaced atomically
+        '''
+        tmpName = fname + '.tmp'
+        with open(tmpName, 'wb') as outFile:
+            outFile.write(Checkpoint.header.pack(
+                Checkpoint.magic, Checkpoint.version))
+            for tag, chunks in sections.items():
+                payload = Checkpoint.packChunks(*chunks)
+                outFile.write(Checkpoint.sectionHeader.pack(tag, len(payload)))
+                outFile.write(payload)
+        os.replace(tmpName, fname)
+
+    @staticmethod
+    def packChunks(*chunks):
+        return b''.join(Checkpoint.chunkHeader.pack(len(chunk)) + bytes(chunk) for chunk in chunks)
+
+    @staticmethod
+    def unpackChunks(view):
+        chunks = []
+        offset = 0
+        while offset < len(view):
+            length, = Checkpoint.chunkHeader.unpack_from(view, offset)
+            offset += Checkpoint.chunkHeader.size
+            chunks.append(view[offset:offset+length])
+            offset += length
+        return chunks
+
+    @staticmethod
+    def packInt(number: int):
+        return number.to_bytes(number.bit_length()//8 + 1, 'little', signed=True)
+
+    @staticmethod
+    def unpackInt(chunk):
+        return int.from_bytes(chunk, 'little', signed=True)
+
+    @staticmethod
+    def packArray(typecode: str, values):
+        arr = array(typecode, values)
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        return arr.tobytes()
+
+    @staticmethod
+    def unpackArray(typecode: str, chunk):
+        arr = array(typecode)
+        arr.frombytes(chunk)
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        return arr
+
+    @staticmethod
+    def packKeys(keys):
+        '''
+        Keys of int, float and str type are supported. return list of chunks: typecode and the data
+        '''
+        keys = list(keys)
+        if all(type(key) == int for key in keys):
+            return [b'q', Checkpoint.packArray('q', keys)]
+        if all(type(key) in (int, float) for key in keys) and all(float(key) == key for key in keys):
+            return [b'd', Checkpoint.packArray('d', keys)]
+        if all(type(key) == str for key in keys):
+            blob = '\0'.join(keys)
+            if blob.count('\0') == max(len(keys) - 1, 0):
+                return [b'z', blob.encode('utf-8', 'surrogatepass')]
+            # some keys contain NUL, so offsets it is
+            encoded = [key.encode('utf-8', 'surrogatepass') for key in keys]
+            offsets = [0]
+            for key in encoded:
+                offsets.append(offsets[-1] + len(key))
+            return [b's', Checkpoint.packArray('Q', offsets), b''.join(encoded)]
+        raise TypeError(
+            "Checkpoint supports events of int, float or str type only")
+
+    @staticmethod
+    def unpackKeys(chunks):
+        typecode = bytes(chunks[0])
+        if typecode in (b'q', b'd'):
+            return Checkpoint.unpackArray(typecode.decode(), chunks[1]).tolist()
+        if typecode == b'z':
+            if not len(chunks[1]):
+                return []
+            return str(chunks[1], 'utf-8', 'surrogatepass').split('\0')
+        offsets = Checkpoint.unpackArray('Q', chunks[1])
+        blob = chunks[2]
+        return [str(blob[offsets[i]:offsets[i+1]], 'utf-8', 'surrogatepass') for i in range(len(offsets) - 1)]
+
+
+class FixedEngine():
+    '''
+    Interval updates for a frozen storage. Probabilities of all the stored events are turned once into integers over a common denominator,
+    then a batch of events becomes a list of integer interval updates for Extractor.composeIntervals with no Fraction maths per event.
+    Batch lookup is numpy.searchsorted over the sorted keys when numpy is installed and events are numbers, dictionary lookup otherwise
+    '''
+
+    def __init__(self, storage, base: int = 2):
+        self.storage = storage
+        probs = {key: tuple(map(fr, Extractor.getProbs(key, storage)))
+                 for key in storage}
+        probs = {key: prob for key, prob in probs.items() if prob[0]}
+        self.denominator = lcm(
+            *(fraction.denominator for prob in probs.values() for fraction in prob))
+        # calcInterval update and entropy of every key:
+        self.table = {key: (int(probSmallerThan*self.denominator), int(probability*self.denominator), self.denominator, -log(probability, base))
+                      for key, (probability, probSmallerThan) in probs.items()}
+        self.keys = None
+        # keys have to survive conversion to a float array
+        if numpy is not None and self.table and all(type(key) in (int, float) and float(key) == key for key in self.table):
+            self.keys = numpy.array(sorted(self.table))
+            self.maps = [self.table[key][:3] for key in self.keys.tolist()]
+            self.entropies = numpy.array(
+                [self.table[key][3] for key in self.keys.tolist()])
+
+    def updates(self, items):
+        '''
+        return (interval updates of the events, entropy of the events). Events out of the storage have zero probability and no update
+        '''
+        if self.keys is not None:
+            events = numpy.asarray(items)
+            if events.dtype.kind in 'iuf' and len(events):
+                indices = numpy.minimum(numpy.searchsorted(
+                    self.keys, events), len(self.keys) - 1)
+                indices = indices[self.keys[indices] == events]
+                entropy = float(numpy.bincount(
+                    indices, minlength=len(self.keys)) @ self.entropies)
+                return [self.maps[i] for i in indices.tolist()], entropy
+        updates = []
+        entropy = 0.
+        for item in items:
+            update = self.table.get(item)
+            if update is not None:
+                updates.append(update[:3])
+                entropy += update[3]
+        return updates, entropy
+
+
+class RangeEngine():
+    '''
+    Bounded precision alternative to the Fraction interval of Extractor.next2.
+    The interval is [low, low+range) in units of base**-digits below the already emitted digits, where base**digits fits into width bits. Top digit is emitted as soon as the interval fits into one cell of it, like in a range decoder, so there is no carry to propagate.
+    Underflow (the interval straddles a top digit border and gets narrower than self.bottom) is resolved by keeping the bigger side of the border.
+    Both interval rounding and underflow lose a bit of entropy compared to the exact engine, the loss is summed up in lostBits (in base-digits)
+    '''
+
+    def __init__(self, base: int = 2, width: int = 32):
+        self.base = base
+        self.digits = int(width/log(base, 2))
+        assert self.digits >= 2, f"Base {base} is too big for {width} bits"
+        self.top = base**self.digits
+        self.cell = base**(self.digits-1)
+        self.bottom = base**(self.digits//2)
+        self.lostBits = 0.
+        self.reset()
+
+    def reset(self):
+        self.low = 0
+        self.range = self.top
+
+    def update(self, probability, probSmallerThan):
+        '''
+        Integer counterpart of Extractor.calcInterval
+        return list of digits that got settled
+        '''
+        if probability == 0:
+            return []
+        pn, pd = probability.numerator, probability.denominator
+        sn, sd = probSmallerThan.numerator, probSmallerThan.denominator
+        start = self.range*sn//sd
+        width = self.range*(sn*pd + pn*sd)//(sd*pd) - start
+        if width == 0:
+            # event less probable than the precision. Take the smallest possible piece of the interval
+            width = 1
+            start = min(start, self.range - 1)
+        self.lostBits += log(self.range*float(probability)/width, self.base)
+        self.low += start
+        self.range = width
+        return self.renormalise()
+
+    def renormalise(self):
+        digits = []
+        while True:
+            digit = self.low//self.cell
+            if digit == (self.low + self.range - 1)//self.cell:
+                digits.append(digit)
+                self.low = (self.low - digit*self.cell)*self.base
+                self.range *= self.base
+                continue
+            if self.range >= self.bottom:
+                return digits
+            border = (digit + 1)*self.cell
+            lower = border - self.low
+            upper = self.low + self.range - border
+            self.lostBits += log(self.range/max(lower, upper), self.base)
+            if lower >= upper:
+                self.range = lower
+            else:
+                self.low = border
+                self.range = upper
+
+
+class Quantizer():
+    '''
+    Converter of input lines to integer bin ids of the values, so that a continuous source gives a storage of a few keys. Bin ids keep the order of the values, infinities and nan are kept as they are
+    spec is 'step:X' for a grid of step X, 'sig:N' for N significant digits or 'bins:N:W' for N bins of equal frequency fitted on the first W events. Warm-up events give None and are not extracted
+    '''
+
+    def __init__(self, spec: str, convert: callable = float):
+        self.spec = spec
+        self.convert = convert
+        # bin edges of bins:N:W, fitted on the warm-up or loaded, see fit()
+        self.edges = None
+        # the largest bin id when it is known, see Extractor.__init__ for the storage choice
+        self.maxID = None
+        kind, *args = spec.split(':')
+        try:
+            if kind == 'step' and len(args) == 1:
+                self.step = float(args[0])
+                assert self.step > 0, "Quantization step has to be positive"
+                self.quantize = self.grid
+            elif kind == 'sig' and len(args) == 1:
+                self.digits = int(args[0])
+                assert self.digits > 0, "Number of significant digits has to be positive"
+                self.scale = 10 ** self.digits
+                self.quantize = self.significant
+            elif kind == 'bins' and len(args) == 2:
+                self.bins, self.warmup = int(args[0]), int(args[1])
+                assert self.bins > 1 and self.warmup >= self.bins, "Bins need a warm-up of at least bins events"
+                self.maxID = self.bins - 1
+                self.sample = []
+                self.quantize = self.fitted
+            else:
+                raise ValueError()
+        except ValueError:
+            raise ValueError(
+                f"Unknown quantization {spec}. Expected step:X, sig:N or bins:N:W") from None
+
+    def __call__(self, line):
+        value = self.convert(line)
+        if not isfinite(value):
+            return value
+        return self.quantize(value)
+
+    def grid(self, value):
+        return floor(value / self.step)
+
+    def significant(self, value):
+        if value == 0:
+            return 0
+        exponent = floor(log10(abs(value)))
+        mantissa = round(abs(value) / 10 ** (exponent - self.digits + 1))
+        if mantissa >= self.scale:
+            mantissa //= 10
+            exponent += 1
+        # exponent of a float is over -400, so the ids of bigger numbers are bigger
+        binID = (exponent + 400) * self.scale + mantissa
+        return binID if value > 0 else -binID
+
+    def fitted(self, value):
+        if self.edges is None:
+            self.sample.append(value)
+            if len(self.sample) == self.warmup:
+                self.sample.sort()
+                self.fit(sorted({self.sample[i * self.warmup // self.bins]
+                                 for i in range(1, self.bins)}))
+            return None
+        return bisect_right(self.edges, value)
+
+    def fit(self, edges):
+        ''' Set the bin edges and end the warm-up. Edges of the saved statistics and checkpoints come back here, see state()
+        '''
+        self.edges = list(edges)
+        self.sample = None
+
+    def state(self):
+        ''' return dictionary of the fitted edges to be saved along with the statistics. Empty when nothing is fitted
+        '''
+        return {'quantize': self.spec, 'edges': self.edges} if self.edges is not None else {}
+
 
 class Extractor():
     @staticmethod
-    def initInp(inp: str, instream: Iterable) -> Iterable:
-        ''' return something iterable: either an input file list of lines or input stream or stdin as iterable
+    def initInp(inp: str, instream: Iterable, inputFormat: str = 'text') -> Iterable:
+        ''' return something iterable: either lines (or records, see RecordReader) of an input file or input stream or stdin as iterable
         '''
         retval = None
-        if inp:
-            with open(inp, 'r') as infile:
-                retval = infile.readlines()
+        if inputFormat != 'text' and not instream:
+            from sys import stdin
+            source = open(inp, 'rb') if inp else stdin.buffer
+            retval = RecordReader(source, inputFormat, closeAtEnd=bool(inp))
+        elif inp:
+            retval = LineReader(open(inp, 'rb'), closeAtEnd=True)
         elif instream:
             retval = instream
         else:
@@ -231,7 +1472,7 @@ class Extractor():
             retval = stdout
         return retval
 
-    def __init__(self, base: int = 2, preNotPostRecalc: bool = True,   revBlock: int = 0, revEntropy: int = 0, saveStats: str = None,  loadStats: str = None,   inp: str = None, outp: str = None,  instream: Iterable = [], str2cmp: callable = float, rounding: float = -1, fixed: dict = None):
+    def __init__(self, base: int = 2, preNotPostRecalc: bool = True,   revBlock: int = 0, revEntropy: int = 0, saveStats: str = None,  loadStats: str = None,   inp: str = None, outp: str = None,  instream: Iterable = [], str2cmp: callable = float, rounding: float = -1, fixed: dict = None, storageType: str = 'dict', engine: str = 'exact', maxFractionBits: int = 0, maxEventUs: float = 0, compactEvents: int = 10000, compactSeconds: float = 0, checkpointFName: str = None, checkpointEvents: int = 0, restoreFName: str = None, inputFormat: str = 'text', outputFormat: str = 'text', flushBytes: int = 0, flushEvents: int = 0, flushMs: float = 0, batchSize: int = 1, metricsFName: str = None, metricsFormat: str = 'prometheus', metricsSeconds: float = 10, workers: int = 0, shard: str = 'roundrobin', blockSize: int = 0, blockStats: str = 'own', window: int = 0, decay: int = 0, maxKeys: int = 0, quantize: str = None):
         '''
         base    -   base of output numbers
         preNotPostRecalc    -   calculate event probability before storing the event to the statistics that probability is calculated with (see lightning probability for clarifications). Note: setting this to False is sort of bit better for security at the cost of latency delay by 1 event per each new event
@@ -239,16 +1480,53 @@ class Extractor():
         revEntropy  -   allow algorithm to store data silently to release output after this amount of entropy is available to be produced
         saveStats   -   save dictionary to this filename to resume processing with this information
         loadStats   -   load data dictionary from this filename
-        inp - input file name
+        inp - input file name or a list of them. Several inputs are extracted with own extractors and merged by loop(), see loopSources. '-' is stdin there
         outp - output file name
         instream    -   iterable containing items objects comparable
         str2cmp -   method to convert input string to object. If uncomparable items are given as input, then 'None' or 'str' should be written. WARNING: most likely you want to use preNotPostRecalc flag set to False when this happens
         revBlockGenerousMode    -   TODO? keep on recalculating history until you get output (works if we get more trivial insertions than revBlock setting, hence 0 output at revBlock insertion)
         round   -   allow this amount of bits to be lost. Expected to be 0..1
         fixed   -   use this dictionary as a fixed storage
+        storageType -   'dict', 'fenwick', 'dense' or 'auto' (dense for u8 and u16le input or bins of the quantizer, dict otherwise). See Extractor.newStorage
+        engine  -   'exact' for Fraction interval maths, 'range32' or 'range64' for the bounded precision RangeEngine
+        maxFractionBits -   soft reset when interval fractions grow longer than this. 0 is off for next2(), feed() keeps to batchFractionBits then
+        maxEventUs  -   soft reset when an event takes longer than this amount of microseconds. 0 is off
+        compactEvents, compactSeconds   -   how often the saveStats journal is compacted into a snapshot, see StatsJournal. 0 is off
+        checkpointFName -   loop() writes the whole extractor state here when done and every checkpointEvents events (0 is off)
+        restoreFName    -   start from the state of this checkpoint file
+        inputFormat -   'text' for lines or one of RecordReader.formats for fixed-width binary records of inp or stdin
+        outputFormat    -   'text' for a character per digit or 'binary' for packed bytes (power of two base only), see OutputWriter
+        flushBytes, flushEvents, flushMs    -   flush policy of loop() output, see OutputWriter. All zeros flush every event
+        batchSize   -   loop() feeds this number of events at once, see feed(). Output waits for the whole batch
+        metricsFName    -   loop() writes metrics() snapshot here every metricsSeconds seconds and when done, in metricsFormat: 'prometheus' text or 'json'. Without it only the counters of metrics() run, not the timers
+        workers -   loop() splits input into this number of substreams, each processed by its own extractor in a worker process, see loopSharded. 0 and 1 are off
+        shard   -   split of input between workers: 'roundrobin' or 'hash' (equal events go to the same worker)
+        blockSize   -   loop() cuts input into blocks of this number of events extracted independently in a process pool of workers processes, see loopBlocks. 0 is off
+        blockStats  -   probabilities of a block: 'own' counts of the block or 'previous' counts of the blocks before it (the first block uses own). Fixed storage is used as is
+        window  -   keep statistics of about the last this number of events only. 0 is off
+        decay   -   halve all counts every this number of events. 0 is off
+        maxKeys -   evict the rarest events when storage has more distinct events than this. 0 is off
+        Statistics are forgotten at soft resets only, see forget()
+        quantize    -   turn numbers into integer bin ids before insertion, see Quantizer for the spec. None is off
         '''
         # Algo settings:
         assert base >= 2, "Output base should be >=2"
+        assert outputFormat == 'text' or base & (base - 1) == 0, "Binary output needs a power of two base"
+        assert workers <= 1 or not (checkpointFName or restoreFName), "Checkpoints are not supported with workers"
+        assert shard in ('roundrobin', 'hash'), f"Unknown shard {shard}"
+        assert blockStats in ('own', 'previous'), f"Unknown block statistics {blockStats}"
+        assert not (window and decay), "Window and decay do not go together"
+        assert not ((window or decay or maxKeys) and (fixed is not None or blockSize)), \
+            "Statistics are not forgotten with fixed storage or blocks"
+        # several inputs
+        self.inputs = None
+        if isinstance(inp, (list, tuple)):
+            if len(inp) > 1:
+                self.inputs = list(inp)
+                assert not (workers > 1 or blockSize or checkpointFName or restoreFName), \
+                    "Several inputs do not go with workers, blocks or checkpoints"
+            inp = inp[0] if inp and not self.inputs else None
+        self.inputFormat = inputFormat
         self.base = base
         # Possible security vulnerability: # Or perhaps a way to use objects without comparison defined
         self.prePost = preNotPostRecalc
@@ -260,33 +1538,121 @@ class Extractor():
         self.revEntropyAccumulating = revEntropy > 0
         self.storeStatisticsFName = saveStats
         self.loadStatisticsFName = loadStats
+        self.journal = None
+        # with workers or several inputs every extractor journals own storage
+        if saveStats and workers <= 1 and not self.inputs:
+            self.journal = StatsJournal(
+                saveStats, compactEvents, compactSeconds)
         # io setup:
-        self.input = Extractor.initInp(inp, instream)
+        self.input = Extractor.initInp(inp, instream, inputFormat)
         self.outp = Extractor.initOutp(outp)
         self.input2object = str2cmp
         if str2cmp is None:
             self.input2object = lambda x: x
+        if isinstance(self.input, RecordReader):
+            # records are numbers already
+            str2cmp = self.input2object = lambda x: x
+        self.quantizer = None
+        if quantize:
+            assert str2cmp not in (None, str), "Quantization needs numeric events"
+            self.quantizer = self.input2object = Quantizer(
+                quantize, self.input2object)
+        if self.journal:
+            self.journal.extra = self.quantizerState
+        if storageType == 'auto':
+            # alphabet of small binary records is known to be small. So are the bin ids of the quantizer when it knows the largest one
+            if self.quantizer:
+                storageType = 'dense' if self.quantizer.maxID is not None and self.quantizer.maxID < DenseStorage.maxSize else 'dict'
+            else:
+                storageType = 'dense' if inputFormat in ('u8', 'u16le') else 'dict'
+        self.storageType = storageType
         # Input items are stored here:
         if self.loadStatisticsFName:
-            with open(self.loadStatisticsFName, 'rb') as infile:
-                self.storage = pickle.load(infile)
+            extra = {}
+            self.storage = StatsJournal.load(self.loadStatisticsFName, extra)
+            if type(self.storage) == dict:
+                self.storage = self.newStorage(self.storage)
+            self.loadQuantizer(extra)
         elif str2cmp in (None, str):
             self.storage = DictionaryEnumerator()
         else:
-            self.storage = {}
+            self.storage = self.newStorage()
         self.backlog = []
+        # Information of the backlog events, see backlogInformation:
+        self.revTracked = None
+        self.revStorage = None
+        self.revSeen = 0
+        self.revCounts = {}
+        self.revLogSum = 0.
+        self.revInterval = None
         # Parameters for interval calculation
         self.entropyAccumulator = 0
         self.outputBitsCount = 0
         self.left = 0
         self.length = 1
+        # Cell of the digits found for the interval so far, see extendOutputApproximation:
+        self.cellLeft = 0
+        self.cellStep = 1
+        self.approxLen = 0
+        self.rangeEngine = None
+        if engine != 'exact':
+            self.rangeEngine = RangeEngine(
+                base, {'range32': 32, 'range64': 64}[engine])
         self.round = rounding
+        self.stats = Metrics()
+        self.metricsFName = metricsFName
+        self.metricsFormat = metricsFormat
+        self.metricsSeconds = metricsSeconds
+        # timers of self.stats cost a few clock reads per event, so they run only when metrics are written or the event time is limited. Counters always run
+        self.timed = bool(metricsFName or maxEventUs)
+        # FixedEngine of the frozen storage for feed(), made on demand:
+        self.fixedEngine = None
+        self.maxFractionBits = maxFractionBits
+        self.maxEventUs = maxEventUs
         self.storageFixed = False
         if fixed is not None:
             self.storageFixed = True
             # if fixed flag is set but no fraction, then loadStatistics is expected
             if fixed:
                 self.storage = fixed
+        self.outputFormat = outputFormat
+        self.flushBytes = flushBytes
+        self.flushEvents = flushEvents
+        self.flushMs = flushMs
+        self.batchSize = batchSize
+        self.checkpointFName = checkpointFName
+        self.checkpointEvents = checkpointEvents if checkpointFName else 0
+        self.workers = workers
+        self.shard = shard
+        # extractors of the several inputs by name, see loopSources
+        self.sources = {}
+        self.blockSize = blockSize
+        self.blockStats = blockStats
+        # forgetting of the old statistics. recent is the ring of the window events, decayed is the events since the last halving
+        self.window = window
+        self.decay = decay
+        self.maxKeys = maxKeys
+        self.recent = deque()
+        self.decayed = 0
+        # Extractor parameters of the workers. Events come to them converted already, str2cmp only picks the storage
+        self.workerParams = {'base': base, 'preNotPostRecalc': preNotPostRecalc, 'revBlock': revBlock, 'revEntropy': revEntropy,
+                             'loadStats': loadStats, 'str2cmp': str if str2cmp in (None, str) else float, 'rounding': rounding,
+                             'fixed': fixed, 'storageType': storageType, 'engine': engine, 'maxFractionBits': maxFractionBits,
+                             'maxEventUs': maxEventUs, 'compactEvents': compactEvents, 'compactSeconds': compactSeconds,
+                             'window': window, 'decay': decay, 'maxKeys': maxKeys}
+        if restoreFName:
+            self.restore(restoreFName)
+
+    def quantizerState(self):
+        ''' return Quantizer.state() to be saved with the statistics, empty without the quantizer
+        '''
+        return self.quantizer.state() if self.quantizer else {}
+
+    def loadQuantizer(self, state: dict):
+        ''' End the warm-up of the quantizer with the edges of state, see Quantizer.state(). Edges of another spec are ignored
+        '''
+        if self.quantizer and state.get('edges') is not None and state.get('quantize') == self.quantizer.spec:
+            self.quantizer.fit(state['edges'])
 
     @staticmethod
     def getProbs(item, storage: dict):
@@ -294,25 +1660,26 @@ class Extractor():
         If there is no such item in storage then prob is zero. Adding to storage before calculating probability is handled by insNewGetProb()
         return (probaility density, Probability function value)
         '''
-        totalEvents = sum(storage.values())
+        # Ordered storages answer without the scan:
+        if hasattr(storage, 'getProbs'):
+            return storage.getProbs(item)
+        if isinstance(storage, EventCounter):
+            totalEvents = storage.total
+        else:
+            totalEvents = sum(storage.values())
         if totalEvents == 0:
             return (0, 0)
         lessThan = 0
-        itemComparable = item
-        # for non-comparable inputs
-        if type(storage) == DictionaryEnumerator:
-            if item not in storage.keys():
-                return (0, 1)
-            itemComparable = storage.getID(item)
         # Count number of events smaller than given:
         for stored, count in storage.items():
             # Optimisation could happen here if we sort the array perhaps
-            if stored >= itemComparable:
+            if stored >= item:
                 continue
             lessThan += count
         lessThanFrac = fr(lessThan, totalEvents)
-        logging.debug(
-            f"GetProbs finished with prob X/{totalEvents} and less than frac {lessThanFrac}. Generated by event {item}({itemComparable}) from storage {storage}")
+        if tracer and tracer.wants('getProbs'):
+            tracer.emit('getProbs', item=item,
+                        total=totalEvents, lessThan=lessThanFrac, storage=storage)
         if item in storage.keys():
             return fr(storage[item], totalEvents), lessThanFrac
         return (0, lessThanFrac)
@@ -326,10 +1693,6 @@ class Extractor():
         inserter = self.insert
         if fixed is not None or self.storageFixed:
             inserter = lambda *ars: None
-        # If fixed is dictionary then use it for getProbs:
-        probsStorage = self.storage if not fixed else fixed
-        if fixed is not None:
-            probsStorage = fixed
         # first entry handling:
         if len(self.storage.keys()) == 0 and not fixed:
             inserter(item)
@@ -337,7 +1700,8 @@ class Extractor():
         # prepost logic:
         if self.prePost:
             inserter(item)
-        probs = Extractor.getProbs(item, probsStorage)
+        # If fixed is dictionary then use it for getProbs. Storage is taken after the insertion, which may replace it:
+        probs = Extractor.getProbs(item, fixed if fixed is not None else self.storage)
         if not self.prePost:
             inserter(item)
         return probs
@@ -349,8 +1713,9 @@ class Extractor():
         If revBlock or revEnt is enabled, then history is considered for recalculation of approximation length with given base
         prevBitsNum will act as a deactivator for revEnt and revBlock action
         '''
-        logging.debug(
-            f"Entered gNONB2 with apprLen {approxLen}, prevBits {prevBitsNum}, hist {history}, revEnt|Block={revEnt}|{revBlock}")
+        if tracer and tracer.wants('numOfNewBits'):
+            tracer.emit('numOfNewBits', approxLen=approxLen, prevBits=prevBitsNum,
+                        history=len(history), revEntropy=revEnt, revBlock=revBlock)
         # Perhaps there is a better way to rewrite these conditions
         if prevBitsNum == 0 and (revBlock or revEnt):
             if revBlock and len(history) < revBlock:
@@ -361,7 +1726,6 @@ class Extractor():
                 # TODO BUG HERE # most likely not anymore
                 newApprox = Extractor.soutputApproximation2(
                     history=history, storage=storage, base=base)
-                logging.debug(f"new approximation for rev check {newApprox}")
                 approxLen = len(newApprox)
             if revEnt and approxLen < revEnt:
                 return 0
@@ -433,16 +1797,25 @@ class Extractor():
 
     @ staticmethod
     def soutputApproximation2(history=None, storage=None, base=2, intervalLeft=0, intervalRight=1):
-        logging.debug(
-            f"Entering approx with hist {history}, stor {storage} LR:{intervalLeft}..{intervalRight}")
+        if tracer and tracer.wants('approximation'):
+            tracer.emit('approximation', history=history, storage=storage,
+                        left=intervalLeft, right=intervalRight)
         if history:
             intervalLeft, length = Extractor.recalcInterval2(
                 history, storage)
             intervalRight = intervalLeft+length
             # logging.debug( f"Changed interval to LR: {intervalLeft}..{intervalRight}")
-        approximationApproximation = 0
+        return Extractor.extendApproximation(intervalLeft, intervalRight, base)[0]
+
+    @ staticmethod
+    def extendApproximation(intervalLeft, intervalRight, base=2, cellLeft=0, cellStep=1):
+        '''
+        Continue the search of soutputApproximation2 below the cell [cellLeft, cellLeft+cellStep) that is already known to contain the interval. Default cell is the whole [0, 1)
+        return (new digits, left edge of the deepest cell containing the interval, size of this cell)
+        '''
+        approximationApproximation = cellLeft
         retValues = []
-        step = fr(1, base)
+        step = fr(cellStep, base)
         coverOK = True
         # Purists will refactor here. This is essentially a base-inary search of interval
         while coverOK:
@@ -463,6 +1836,7 @@ class Extractor():
                 if intervalLeft >= approximationApproximation and \
                         intervalRight <= appRight:
                     retValues.append(s)
+                    cellLeft, cellStep = approximationApproximation, step
                     break
                 elif intervalRight < intervalLeft:
                     logging.critical(
@@ -471,11 +1845,95 @@ class Extractor():
                     sys.exit(1)
                 approximationApproximation += step
             else:
-                logger.warn(
+                logging.warning(
                     "Approximation moved through whole range of base and found no positive nor negative conditions")
-                return retValues
+                return retValues, cellLeft, cellStep
             step = step/base
-        return retValues
+        return retValues, cellLeft, cellStep
+
+    def extendOutputApproximation(self):
+        '''
+        Incremental version of generateOutputApproximation2 for the current interval.
+        Interval only shrinks inside the cell of already found digits, so only the digits below it are searched for, the way arithmetic decoder renormalises
+        return the new digits. self.approxLen is the length of the whole approximation
+        '''
+        left, length = fr(self.left), fr(self.length)
+        # cell is [cellIndex, cellIndex+1]/scale. Search is done in integers of the interval relative to the cell
+        scale = fr(self.cellStep).denominator
+        cellLeft = fr(self.cellLeft)
+        cellIndex = cellLeft.numerator * (scale // cellLeft.denominator)
+        denominator = left.denominator * length.denominator
+        intervalLeft = (left.numerator * scale - cellIndex *
+                        left.denominator) * length.denominator
+        intervalRight = intervalLeft + length.numerator * scale * left.denominator
+        if intervalLeft < 0 or intervalRight > denominator:
+            # interval was replaced, not narrowed: start from the top
+            scale, cellIndex, self.approxLen = 1, 0, 0
+            intervalLeft = left.numerator * length.denominator
+            intervalRight = intervalLeft + length.numerator * left.denominator
+        index, newDigits = Extractor.cellDigits(
+            intervalLeft, intervalRight, denominator, self.base)
+        scale *= self.base**newDigits
+        self.cellLeft = fr(cellIndex * self.base**newDigits + index, scale)
+        self.cellStep = fr(1, scale)
+        self.approxLen += newDigits
+        return Extractor.indexDigits(index, newDigits, self.base)
+
+    @staticmethod
+    def cellDigits(intervalLeft: int, intervalRight: int, denominator: int, base: int = 2):
+        '''
+        Integer version of extendApproximation for the interval [intervalLeft, intervalRight]/denominator inside [0, 1]
+        return (index, digits): [index, index+1]/base**digits is the deepest cell containing the interval
+        '''
+        # cell can not be smaller than the interval. Cells containing the interval are nested, so binary search of the deepest
+        lower = 0
+        upper = int((denominator.bit_length() - (intervalRight -
+                    intervalLeft).bit_length() + 1) / log(base, 2)) + 2
+        # Leading bits of the numbers are enough to decide unless the interval ends are very close to the cell edges
+        shift = max(0, denominator.bit_length() -
+                    int(upper * log(base, 2)) - 64)
+        leftHigh, rightHigh, denominatorHigh = intervalLeft >> shift, intervalRight >> shift, denominator >> shift
+
+        def cell(digits):
+            scale = base**digits
+            if shift:
+                index = leftHigh * scale // (denominatorHigh + 1)
+                if index == (leftHigh + 1) * scale // denominatorHigh:
+                    if (rightHigh + 1) * scale <= (index + 1) * denominatorHigh:
+                        return index
+                    if rightHigh * scale > (index + 1) * (denominatorHigh + 1):
+                        return None
+            index = intervalLeft * scale // denominator
+            # right end of the interval may lie on the right edge of the cell
+            return index if intervalRight * scale <= (index + 1) * denominator else None
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            if cell(middle) is None:
+                upper = middle
+            else:
+                lower = middle
+        return cell(lower), lower
+
+    @staticmethod
+    def indexDigits(index: int, length: int, base: int = 2):
+        '''
+        return list of length base-digits of index, most significant first
+        '''
+        if length > 64:
+            # halves are converted separately so that the divisions are few and not of huge by tiny numbers
+            half = length // 2
+            high, low = divmod(index, base**half)
+            return Extractor.indexDigits(high, length - half, base) + Extractor.indexDigits(low, half, base)
+        digits = [0] * length
+        for i in range(length - 1, -1, -1):
+            index, digits[i] = divmod(index, base)
+        return digits
+
+    def approximationDigits(self):
+        '''
+        Same as generateOutputApproximation2() after extendOutputApproximation(): digits of the current cell
+        '''
+        return Extractor.indexDigits(int(self.cellLeft/self.cellStep), self.approxLen, self.base)
 
     def generateOutputApproximation(self, length):
         outputApprox = self.left+self.length/2
@@ -493,7 +1951,6 @@ class Extractor():
             else:
                 retValues.append(self.base-1)
             step = step/self.base
-        logging.debug(f"Approximation is {retValues}")
         return retValues
 
     @ staticmethod
@@ -522,63 +1979,376 @@ class Extractor():
         for item in history:
             self.updateInterval(*Extractor.getProbs(item, self.storage))
 
+    def backlogInformation(self):
+        '''
+        Information of the backlog events in base-digits: sum of -log(count/total) with the current storage counts, which is -log of the length of the backlog interval.
+        Kept up to date per event, the backlog is counted again only when it was replaced
+        '''
+        backlog, storage = self.backlog, self.storage
+        if self.revTracked is not backlog or self.revStorage is not storage or self.revSeen != len(backlog) - 1:
+            self.revTracked, self.revStorage = backlog, storage
+            # item: (its events in the backlog, storage count when last looked at)
+            self.revCounts = {}
+            self.revLogSum = 0.
+            new = backlog
+        else:
+            new = backlog[-1:]
+        for item in new:
+            seen, count = self.revCounts.get(item, (0, 1))
+            self.revLogSum -= seen * log(count)
+            # events left from before convert2stringing are not in storage. Counting them as 1 keeps the bound an upper one
+            count = storage[item] if item in storage else 1
+            self.revLogSum += (seen + 1) * log(count)
+            self.revCounts[item] = (seen + 1, count)
+        self.revSeen = len(backlog)
+        return (len(backlog) * log(self.totalEvents()) - self.revLogSum) / log(self.base)
+
+    def revNewBits(self):
+        '''
+        getNumOfNewBits2 for the rev-block/rev-entropy backlog without the recalculation of the whole backlog for every event.
+        Approximation can not be longer than backlogInformation(), so the exact interval is made only when this bound allows the release. It is kept in self.revInterval
+        return number of new digits, 0 while gathering
+        '''
+        backlog, storage = self.backlog, self.storage
+        if not storage or not backlog:
+            return Extractor.getNumOfNewBits2(0, 0, history=backlog, storage=storage, revEnt=self.revEntropy, revBlock=self.revBlock, base=self.base)
+        if tracer and tracer.wants('numOfNewBits'):
+            tracer.emit('numOfNewBits', approxLen=0, prevBits=0,
+                        history=len(backlog), revEntropy=self.revEntropy, revBlock=self.revBlock)
+        bound = self.backlogInformation()
+        if self.revBlock and len(backlog) < self.revBlock:
+            return 0
+        # float sum is off by far less than the margin
+        if bound + 1e-6 * (len(backlog) + 1) < max(self.revEntropy, 1):
+            return 0
+        probs = {}
+        maps = []
+        for item in backlog:
+            if item not in probs:
+                probability, probSmallerThan = map(
+                    fr, Extractor.getProbs(item, storage))
+                denominator = lcm(probability.denominator,
+                                  probSmallerThan.denominator)
+                probs[item] = (probSmallerThan.numerator * (denominator // probSmallerThan.denominator),
+                               probability.numerator * (denominator // probability.denominator), denominator)
+            if probs[item][1]:
+                maps.append(probs[item])
+        if not maps:
+            return 0
+        left, length, denominator = Extractor.composeIntervals(maps)
+        digits = Extractor.cellDigits(
+            left, left + length, denominator, self.base)[1]
+        if digits < self.revEntropy:
+            return 0
+        self.revInterval = (fr(left, denominator), fr(length, denominator))
+        return digits
+
     def next2(self, item, fixed=None):
         '''
         It is possible to put fixed dictionary here and use it without setting it in the constructor. Not sure if anyone would use it
         '''
-        #logging.debug(f"Enter next2 with new item {item}")
+        if tracer:
+            tracer.tick()
+        stats = self.stats
+        timed = self.timed
+        if timed:
+            started = perf_counter()
+            stats.arrived(started)
+        else:
+            started = 0
+            stats.events += 1
         probs = self.insNewGetProb(item, fixed=fixed)
+        probsDone = 0
+        if timed:
+            probsDone = perf_counter()
+            stats.seconds['probs'] += probsDone - started
+        if self.rangeEngine:
+            return self.nextRange(item, probs, probsDone)
         #probs = self.insNewGetProb(item)
-        self.left, self.length = Extractor.calcInterval(
-            (self.left, self.length), probs)
-        approx = self.generateOutputApproximation2()
-        newBits = Extractor.getNumOfNewBits2(
-            len(approx), self.outputBitsCount, history=self.backlog,
-            storage=self.storage, revEnt=self.revEntropy,
-            revBlock=self.revBlock, base=self.base)
+        gathering = self.outputBitsCount == 0 and (
+            self.revBlock or self.revEntropy)
+        if gathering:
+            # interval is made from the whole backlog at the release by revNewBits
+            approx = []
+            intervalDone = probsDone
+            newBits = self.revNewBits()
+        else:
+            self.left, self.length = Extractor.calcInterval(
+                (self.left, self.length), probs)
+            if timed:
+                intervalDone = perf_counter()
+                stats.seconds['interval'] += intervalDone - probsDone
+            approx = self.extendOutputApproximation()
+            newBits = Extractor.getNumOfNewBits2(
+                self.approxLen, self.outputBitsCount, history=self.backlog,
+                storage=self.storage, revEnt=self.revEntropy,
+                revBlock=self.revBlock, base=self.base)
         self.entropyAccumulator += self.getEntropyOfThis(item, prob=probs[0])
         if (self.revBlock or self.revEntropy) and newBits:
-            logging.debug("Detected rev-Block/Entropy been satisfied")
+            if tracer and tracer.wants('release'):
+                tracer.emit('release', backlog=len(self.backlog))
             self.revBlock = 0
             self.revEntropy = 0
-            # This is not quite optimal since this method has already been called in getNumOfNewBits2. Refactor maybe
-            approx = self.generateOutputApproximation2(self.backlog)
-            # backlog=[] is a flag to not recalc interval in getNumOfNewBits2
             self.entropyAccumulator = self.getTotalTheoreticalEntropy()
-            # interval recalc is performed in generateOutputApprox..<-refactor?
-            self.recalcInterval(self.backlog)
+            if gathering:
+                self.left, self.length = self.revInterval
+            else:
+                self.recalcInterval(self.backlog)
+            approx = self.extendOutputApproximation()
             self.backlog = []
             # if this branch is met then kind of an incorrect probs is passed to debug output
         self.outputBitsCount += newBits
-        logging.debug(
-            f"Nexted {item} to form {self.storage} now entorpy is {self.entropyAccumulator:.2f} with probs {probs} and output bits {self.outputBitsCount} and new bits is {newBits}")
+        if timed:
+            approximationDone = perf_counter()
+            stats.seconds['approximation'] += approximationDone - intervalDone
+            if newBits:
+                stats.emitted(newBits, approximationDone)
+        else:
+            stats.digits += newBits
+        if tracer and tracer.wants('next2'):
+            tracer.emit('next2', item=item, probs=probs, entropy=self.entropyAccumulator,
+                        outputBits=self.outputBitsCount, newBits=newBits, keys=len(self.storage))
         if not newBits:
+            self.keepBudget(started)
             return (False, [])
+        # digits are taken before a soft reset drops the cell
+        if 0 < newBits <= len(approx):
+            digits = approx[-newBits:]
+        else:
+            digits = self.approximationDigits()[-newBits:]
         # soft reset part <- for refactor
-        logging.debug(
-            f" {self.round}>0 and {self.entropyAccumulator} - {self.round} < {self.outputBitsCount}")
         if self.round > 0 and (self.entropyAccumulator - self.round < self.outputBitsCount):
-            logging.debug(f"Doing soft reset with round={self.round}")
             self.softReset()
-        return (True,  approx[-newBits:])
+        else:
+            self.keepBudget(started)
+        return (True, digits)
+
+    def keepBudget(self, started=0):
+        '''
+        Soft reset when the interval arithmetic got too expensive: the fractions grew longer than maxFractionBits or the event took longer than maxEventUs since started.
+        Also when old statistics are to be forgotten, see forget()
+        Not done while rev-block/rev-entropy data is gathered because soft reset drops the backlog
+        '''
+        if self.revBlock or self.revEntropy:
+            return
+        # left and length are within 0..1 so the denominators are the longest parts
+        if self.maxFractionBits and max(self.left.denominator.bit_length(), self.length.denominator.bit_length()) > self.maxFractionBits:
+            if tracer and tracer.wants('budget'):
+                tracer.emit('budget', maxFractionBits=self.maxFractionBits)
+            self.softReset()
+        elif self.maxEventUs and (perf_counter() - started)*1e6 > self.maxEventUs:
+            if tracer and tracer.wants('budget'):
+                tracer.emit('budget', maxEventUs=self.maxEventUs)
+            self.softReset()
+        elif self.forgetDue():
+            self.softReset()
+
+    def nextRange(self, item, probs, started: float = 0):
+        '''
+        The part of next2 after the probabilities for the bounded precision engine: the interval lives in self.rangeEngine instead of self.left and self.length
+        '''
+        self.entropyAccumulator += self.getEntropyOfThis(item, prob=probs[0])
+        if self.revBlock or self.revEntropy:
+            # readiness is decided by the exact maths same as in next2. Then the block is replayed through the engine
+            if not self.revNewBits():
+                return (False, [])
+            self.revBlock = 0
+            self.revEntropy = 0
+            self.entropyAccumulator = self.getTotalTheoreticalEntropy()
+            self.rangeEngine.reset()
+            digits = []
+            for event in self.backlog:
+                digits += self.rangeEngine.update(
+                    *Extractor.getProbs(event, self.storage))
+            self.backlog = []
+        else:
+            digits = self.rangeEngine.update(*probs)
+        self.outputBitsCount += len(digits)
+        if self.timed:
+            now = perf_counter()
+            self.stats.seconds['interval'] += now - started
+            if digits:
+                self.stats.emitted(len(digits), now)
+        else:
+            self.stats.digits += len(digits)
+        if not digits:
+            return (False, [])
+        if self.round > 0 and (self.entropyAccumulator - self.round < self.outputBitsCount) or self.forgetDue():
+            self.softReset()
+        return (True, digits)
+
+    # fraction budget of feed() when maxFractionBits is 0
+    batchFractionBits = 1 << 14
+
+    def batchable(self):
+        '''
+        True when events can be processed without looking at the output after every one of them: no per-event soft resets, rev modes or the range engine
+        '''
+        return not (self.rangeEngine or self.round > 0 or self.revBlock or self.revEntropy or self.maxEventUs)
+
+    def feed(self, iterable):
+        '''
+        Process a batch of events. Digits are the same as of next2() called for every event until the fractions outgrow maxFractionBits
+        (batchFractionBits when it is 0): then the soft reset comes after the batch, not after the event
+        return digits produced as one buffer: bytearray or array('L') for bases over 256
+        '''
+        output = bytearray() if self.base <= 256 else array('L')
+        if not self.batchable():
+            for item in iterable:
+                succ, digits = self.next2(item)
+                if succ:
+                    output.extend(digits)
+            return output
+        # Interval only shrinks inside the cell of already found digits, so digits of the whole batch are searched for once
+        # and the interval updates of the batch are composed in integers before the single Fraction update
+        stats = self.stats
+        timed = self.timed
+        if timed:
+            started = perf_counter()
+            stats.arrived(started, 0)
+        if self.storageFixed:
+            if self.fixedEngine is None or self.fixedEngine.storage is not self.storage:
+                self.fixedEngine = FixedEngine(self.storage, self.base)
+            items = iterable if isinstance(
+                iterable, (list, tuple)) else list(iterable)
+            if tracer:
+                tracer.tick(len(items))
+            maps, entropy = self.fixedEngine.updates(items)
+            self.entropyAccumulator += entropy
+            stats.events += len(items)
+        else:
+            maps = []
+            for item in iterable:
+                stats.events += 1
+                if tracer:
+                    tracer.tick()
+                probability, probSmallerThan = map(
+                    fr, self.insNewGetProb(item))
+                if probability:
+                    denominator = lcm(probability.denominator,
+                                      probSmallerThan.denominator)
+                    maps.append((probSmallerThan.numerator * (denominator // probSmallerThan.denominator),
+                                probability.numerator * (denominator // probability.denominator), denominator))
+                self.entropyAccumulator += self.getEntropyOfThis(
+                    item, prob=probability)
+        if timed:
+            probsDone = perf_counter()
+            stats.seconds['probs'] += probsDone - started
+        if maps:
+            left, length, denominator = Extractor.composeIntervals(maps)
+            self.left, self.length = Extractor.calcInterval(
+                (self.left, self.length), (fr(length, denominator), fr(left, denominator)))
+        if timed:
+            intervalDone = perf_counter()
+            stats.seconds['interval'] += intervalDone - probsDone
+        approx = self.extendOutputApproximation()
+        newBits = self.approxLen - self.outputBitsCount
+        self.outputBitsCount += newBits
+        if timed:
+            approximationDone = perf_counter()
+            stats.seconds['approximation'] += approximationDone - intervalDone
+            if newBits:
+                stats.emitted(newBits, approximationDone)
+        else:
+            stats.digits += newBits
+        if tracer and tracer.wants('feed'):
+            tracer.emit('feed', updates=len(maps), entropy=self.entropyAccumulator,
+                        outputBits=self.outputBitsCount, newBits=newBits)
+        if 0 < newBits <= len(approx):
+            output.extend(approx[-newBits:])
+        elif newBits:
+            output.extend(self.approximationDigits()[-newBits:])
+        # exact fractions would grow with every batch and make the next one slower, so they are kept under the budget between the batches.
+        # Statistics are forgotten between the batches too, so the caps may be exceeded by a batch
+        budget = self.maxFractionBits or Extractor.batchFractionBits
+        if max(self.left.denominator.bit_length(), self.length.denominator.bit_length()) > budget:
+            if tracer and tracer.wants('budget'):
+                tracer.emit('budget', maxFractionBits=budget)
+            self.softReset()
+        elif self.forgetDue():
+            self.softReset()
+        return output
+
+    @staticmethod
+    def composeIntervals(maps):
+        '''
+        maps are interval updates (left, length, denominator) in integers: calcInterval with probabilities length/denominator and left/denominator
+        return the update equal to all of them applied in order. Pairs are merged tree-wise so that the multiplied numbers are of similar size
+        '''
+        while len(maps) > 1:
+            merged = []
+            for i in range(0, len(maps) - 1, 2):
+                (left1, length1, denominator1), (left2,
+                                                 length2, denominator2) = maps[i], maps[i+1]
+                merged.append((left1 * denominator2 + length1 * left2,
+                              length1 * length2, denominator1 * denominator2))
+            if len(maps) % 2:
+                merged.append(maps[-1])
+            maps = merged
+        return maps[0]
+
+    def feedMany(self, sequence):
+        '''
+        feed() for a sequence: the saveStats journal gets one record for the whole batch instead of one per event
+        '''
+        if not (self.journal and self.batchable()):
+            return self.feed(sequence)
+        journal, self.journal = self.journal, None
+        try:
+            output = self.feed(sequence)
+        finally:
+            self.journal = journal
+        if not self.storageFixed:
+            journal.record(self.storage, sequence)
+        return output
+
+    def metrics(self):
+        '''
+        return dictionary of the counters and timers, see Metrics. Entropy and digits are in base-digits
+        '''
+        stats = self.stats
+        total = self.totalEvents()
+        left, length = fr(self.left), fr(self.length)
+        return {'events': stats.events, 'digits': stats.digits,
+                'digitsPerEvent': stats.digits / stats.events if stats.events else 0.,
+                'entropyPerEvent': self.getTotalTheoreticalEntropy() / total if total else 0.,
+                'seconds': dict(stats.seconds),
+                'softResets': stats.softResets, 'lostEntropy': stats.lostEntropy,
+                'fractionBits': {'leftNumerator': left.numerator.bit_length(), 'leftDenominator': left.denominator.bit_length(),
+                                 'lengthNumerator': length.numerator.bit_length(), 'lengthDenominator': length.denominator.bit_length()},
+                'latency': {'last': stats.latencyLast, 'max': stats.latencyMax,
+                            'mean': stats.latencyTotal / stats.emissions if stats.emissions else 0.},
+                'keys': len(self.storage),
+                **({'sources': {name: e.metrics() for name, e in self.sources.items()}} if self.sources else {})}
+
+    def getLostEntropy(self):
+        '''
+        Entropy (in base-digits) lost by the bounded precision engine compared to the exact one
+        '''
+        if self.rangeEngine:
+            return self.rangeEngine.lostBits
+        return 0
 
     def next(self, item):
         probs = self.insNewGetProb(item)
         newBits = self.getNumOfNewBits(probs[0])
         self.entropyAccumulator += self.getEntropyOfThis(item, prob=probs[0])
         self.updateInterval(*probs)
-        logging.debug(
-            f"Nexted {item} to form {self.storage} now entorpy is {self.entropyAccumulator} with probs {probs} and output bits {self.outputBitsCount} and new bits is {newBits}")
+        if tracer:
+            tracer.tick()
+            if tracer.wants('next'):
+                tracer.emit('next', item=item, probs=probs, entropy=self.entropyAccumulator,
+                            outputBits=self.outputBitsCount, newBits=newBits, keys=len(self.storage))
         if self.revBlockAccumulating or self.revEntropyAccumulating:
             if self.totalEvents() >= self.revBlock:
                 self.revBlockAccumulating = False
-            self.left, self.length = Extractor.recalcInterval2(
-                self.backlog, self.storage)
             self.entropyAccumulator = self.getTotalTheoreticalEntropy()
             if self.entropyAccumulator >= self.revEntropy:
                 self.revEntropyAccumulating = False
-            logging.debug(
-                f"Recalculated stuff due to block nature. Now inserted {item} to form {self.storage} now entorpy is {self.entropyAccumulator} with probs {probs} and output bits {self.outputBitsCount} and new bits is {newBits}")
+            # interval of the backlog is needed for the output and for going on after the gathering only
+            if newBits > 0 or not (self.revBlockAccumulating or self.revEntropyAccumulating):
+                self.left, self.length = Extractor.recalcInterval2(
+                    self.backlog, self.storage)
         if newBits > 0:
             # If in block mode and it's time to spit new bits: recalc interval and update entropyAccumulator accordingly
             randnum = self.generateOutputApproximation(
@@ -608,23 +2378,431 @@ class Extractor():
         self.prePost = False
 
     def loop(self):
+        # output may be replaced after __init__, so writer is made here
+        writer = OutputWriter(self.outp, self.base, self.outputFormat,
+                              self.flushBytes, self.flushEvents, self.flushMs)
+        if self.inputs:
+            return self.loopSources(writer)
+        if self.blockSize:
+            return self.loopBlocks(writer)
+        if self.workers > 1:
+            return self.loopSharded(writer)
+        events = 0
+        batch = []
+        timed = self.timed
+        ioStarted = perf_counter()
+        snapshotted = monotonic()
         for line in self.input:
+            if timed:
+                self.stats.seconds['io'] += perf_counter() - ioStarted
+            if self.metricsFName and monotonic() - snapshotted >= self.metricsSeconds:
+                Metrics.write(self.metricsFName, self.metrics(),
+                              self.metricsFormat)
+                snapshotted = monotonic()
             if line == '' or line == '\n' or line == '\r\n':
+                if timed:
+                    ioStarted = perf_counter()
                 continue
+            events += 1
             try:
                 item = self.input2object(line)
             except ValueError:
+                self.feedBatch(batch, writer)
                 self.convert2stringing()
                 item = self.input2object(line)
-            # succ, arr = self.next(item)
-            succ, arr = self.next2(item)
-            if succ:
-                if verbosity > 3:
-                    self.outp.write('>> ')
-                self.outp.write(''.join(map(str, arr)))
-                if verbosity > 3:
-                    self.outp.write('\n')
-                self.outp.flush()
+            # None is quantization warm-up
+            if item is not None:
+                batch.append(item)
+                if len(batch) >= self.batchSize:
+                    self.feedBatch(batch, writer)
+            if self.checkpointEvents and events % self.checkpointEvents == 0:
+                # checkpoint holds exactly the first events lines, their output is out before it
+                self.feedBatch(batch, writer)
+                writer.flush()
+                self.checkpoint(self.checkpointFName)
+            if timed:
+                ioStarted = perf_counter()
+        self.feedBatch(batch, writer)
+        writer.close()
+        if self.metricsFName:
+            Metrics.write(self.metricsFName, self.metrics(), self.metricsFormat)
+        if self.journal:
+            self.journal.close()
+        if self.checkpointFName:
+            self.checkpoint(self.checkpointFName)
+        if self.rangeEngine:
+            logging.info(
+                f"Range engine lost {self.getLostEntropy():.3f} digits of entropy compared to the exact one")
+
+    def loopSharded(self, writer):
+        '''
+        loop() over the worker processes. Input is cut into rounds of workers*max(batchSize, shardBatch) events, events of a round are split between workers by self.shard.
+        Output of a round is the digits of worker 0 for its part of the round, then of worker 1 and so on, so it is the same for the same input and settings however fast the workers are
+        '''
+        workers = self.workers
+        context = multiprocessing.get_context()
+        inboxes = [context.Queue() for _ in range(workers)]
+        outboxes = [context.Queue() for _ in range(workers)]
+        processes = []
+        for i in range(workers):
+            params = dict(self.workerParams)
+            if self.storeStatisticsFName:
+                params['saveStats'] = f"{self.storeStatisticsFName}.{i}"
+            processes.append(context.Process(target=shardWorker, args=(
+                params, inboxes[i], outboxes[i]), daemon=True))
+        for process in processes:
+            process.start()
+        roundSize = workers * max(self.batchSize, Extractor.shardBatch)
+        # workers of every round in flight
+        pending = deque()
+
+        def collect():
+            for i in pending.popleft():
+                while True:
+                    try:
+                        digits = outboxes[i].get(timeout=1)
+                        break
+                    except queue.Empty:
+                        if not processes[i].is_alive():
+                            raise RuntimeError(
+                                f"Worker {i} exited with code {processes[i].exitcode}")
+                now = perf_counter()
+                if digits:
+                    writer.write(digits)
+                    self.stats.emitted(len(digits), now)
+                self.stats.seconds['io'] += perf_counter() - now
+
+        def dispatch(batch):
+            parts = [[] for _ in range(workers)]
+            if self.shard == 'hash':
+                for item in batch:
+                    parts[Extractor.shardHash(item) % workers].append(item)
+            else:
+                for i in range(workers):
+                    parts[i] = batch[i::workers]
+            busy = [i for i in range(workers) if parts[i]]
+            for i in busy:
+                inboxes[i].put(parts[i])
+            pending.append(busy)
+            self.stats.arrived(perf_counter(), len(batch))
+            batch.clear()
+            # a few rounds in flight keep workers busy while the output of the oldest one is written
+            while len(pending) > Extractor.shardRounds:
+                collect()
+        batch = []
+        snapshotted = monotonic()
+        try:
+            for line in self.input:
+                if line == '' or line == '\n' or line == '\r\n':
+                    continue
+                try:
+                    item = self.input2object(line)
+                except ValueError:
+                    if batch:
+                        dispatch(batch)
+                    self.convert2stringing()
+                    for inbox in inboxes:
+                        inbox.put(Extractor.shardConvert)
+                    item = self.input2object(line)
+                if item is None:
+                    continue
+                batch.append(item)
+                if len(batch) >= roundSize:
+                    dispatch(batch)
+                    if self.metricsFName and monotonic() - snapshotted >= self.metricsSeconds:
+                        Metrics.write(self.metricsFName,
+                                      self.metrics(), self.metricsFormat)
+                        snapshotted = monotonic()
+            if batch:
+                dispatch(batch)
+            while pending:
+                collect()
+            for inbox in inboxes:
+                inbox.put(None)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        writer.close()
+        if self.metricsFName:
+            Metrics.write(self.metricsFName, self.metrics(), self.metricsFormat)
+
+    def loopBlocks(self, writer):
+        '''
+        loop() over blocks of blockSize events. Probabilities of a block are frozen before its extraction (see blockStats), so blocks are extracted independently by blockDigits in a pool of self.workers processes (all cores when 0).
+        Output is the digits of the blocks in order. Every block starts from the whole [0, 1) interval, so fractions do not grow over one block.
+        entropyAccumulator gets the information of every block under its probabilities
+        '''
+        workers = self.workers or os.cpu_count() or 1
+        pool = ProcessPoolExecutor(workers)
+        # blocks in flight: enough to keep the pool busy while the oldest one is written
+        depth = 2 * workers
+        pending = deque()
+        # blocks are released whole, there is no backlog to gather
+        self.revBlock = self.revEntropy = 0
+        if self.blockStats == 'previous' and type(self.storage) == CountingStorage:
+            # probabilities of the block events are looked up in the counts of the whole input before it
+            self.storage = FenwickStorage(self.storage)
+
+        def collect():
+            digits = pending.popleft().result()
+            now = perf_counter()
+            if digits:
+                writer.write(digits)
+                self.stats.emitted(len(digits), now)
+            self.stats.seconds['io'] += perf_counter() - now
+
+        def dispatch(block):
+            probs = None
+            if self.storageFixed or self.blockStats == 'previous' and self.storage:
+                probs = {key: Extractor.getProbs(key, self.storage)
+                         for key in set(block)}
+            counts = Counter(block)
+            if probs is None:
+                self.entropyAccumulator += CountingStorage(counts).entropy(self.base)
+            else:
+                self.entropyAccumulator += sum(-count * log(1. * probs[key][0], self.base)
+                                               for key, count in counts.items() if probs[key][0])
+            # storage keeps counts of the whole input, for blockStats and saveStats
+            self.insert(*block)
+            events = list(block)
+            if probs is None and isinstance(self.storage, DictionaryEnumerator):
+                # strings are ordered by arrival, same as in the enumerator
+                events = [self.storage.lookup[item] for item in block]
+            pending.append(pool.submit(blockDigits, events, probs, self.base))
+            self.stats.arrived(perf_counter(), len(block))
+            block.clear()
+            while len(pending) > depth:
+                collect()
+        block = []
+        snapshotted = monotonic()
+        try:
+            for line in self.input:
+                if line == '' or line == '\n' or line == '\r\n':
+                    continue
+                try:
+                    item = self.input2object(line)
+                except ValueError:
+                    # blocks are not mixing numbers and strings
+                    if block:
+                        dispatch(block)
+                    self.convert2stringing()
+                    item = self.input2object(line)
+                if item is None:
+                    continue
+                block.append(item)
+                if len(block) >= self.blockSize:
+                    dispatch(block)
+                    if self.metricsFName and monotonic() - snapshotted >= self.metricsSeconds:
+                        Metrics.write(self.metricsFName,
+                                      self.metrics(), self.metricsFormat)
+                        snapshotted = monotonic()
+            if block:
+                dispatch(block)
+            while pending:
+                collect()
+        finally:
+            pool.shutdown(cancel_futures=True)
+        writer.close()
+        if self.metricsFName:
+            Metrics.write(self.metricsFName, self.metrics(), self.metricsFormat)
+        if self.journal:
+            self.journal.close()
+
+    def loopSources(self, writer):
+        '''
+        loop() over several inputs, every one with own extractor of the same settings. Input that has data is processed without waiting for the others: pipes and devices are polled with selectors, regular files are always ready.
+        Digits are written as soon as a read of a source is extracted, so the order of sources in output depends on timing. metrics() has the snapshot of every source
+        '''
+        selector = selectors.DefaultSelector()
+        # regular files are not supported by epoll
+        ready = []
+        self.sources = {}
+        for i, name in enumerate(self.inputs):
+            source = open(0 if name == '-' else name, 'rb',
+                          buffering=0, closefd=name != '-')
+            reader = RecordReader(source, self.inputFormat, InputSource.chunkSize) if self.inputFormat != 'text' else \
+                LineReader(source, InputSource.chunkSize)
+            reader.closeAtEnd = True
+            params = dict(self.workerParams)
+            if self.storeStatisticsFName:
+                params['saveStats'] = f"{self.storeStatisticsFName}.{i}"
+            inputSource = InputSource(name, reader, Extractor(**params))
+            inputSource.extractor.timed = self.timed
+            # warm-up of quantization is per source
+            if self.quantizer:
+                # edges loaded with the statistics are shared
+                quantizer = Quantizer(self.quantizer.spec, self.quantizer.convert)
+                if self.quantizer.edges is not None:
+                    quantizer.fit(self.quantizer.edges)
+                inputSource.extractor.quantizer = inputSource.extractor.input2object = quantizer
+            else:
+                inputSource.extractor.input2object = self.input2object
+            self.sources[name] = inputSource.extractor
+            if stat.S_ISREG(os.fstat(source.fileno()).st_mode):
+                ready.append(inputSource)
+            else:
+                selector.register(source, selectors.EVENT_READ, inputSource)
+        snapshotted = monotonic()
+        while ready or selector.get_map():
+            # files do not wait for the slow pipes
+            polled = [key.data for key, _ in selector.select(0 if ready else None)] \
+                if selector.get_map() else []
+            for inputSource in ready + polled:
+                started = perf_counter()
+                digits = inputSource.process(
+                    self.inputFormat == 'text' or self.quantizer is not None)
+                now = perf_counter()
+                self.stats.arrived(started, inputSource.processed)
+                if digits:
+                    writer.write(digits)
+                    self.stats.emitted(len(digits), now)
+                self.stats.seconds['io'] += perf_counter() - now
+                if inputSource.reader.source is None:
+                    if inputSource in ready:
+                        ready.remove(inputSource)
+                    else:
+                        selector.unregister(inputSource.source)
+                    if inputSource.extractor.journal:
+                        inputSource.extractor.journal.close()
+            if self.metricsFName and monotonic() - snapshotted >= self.metricsSeconds:
+                Metrics.write(self.metricsFName, self.metrics(), self.metricsFormat)
+                snapshotted = monotonic()
+        selector.close()
+        writer.close()
+        if self.metricsFName:
+            Metrics.write(self.metricsFName, self.metrics(), self.metricsFormat)
+
+    # events per worker in a round of loopSharded at least, rounds in flight and the message to convert2stringing
+    shardBatch = 1024
+    shardRounds = 4
+    shardConvert = 'convert2stringing'
+
+    @staticmethod
+    def shardHash(item):
+        '''
+        Hash of the event that is the same in every run: hash() of strings is salted per process
+        '''
+        if isinstance(item, str):
+            return crc32(item.encode())
+        if isinstance(item, bytes):
+            return crc32(item)
+        if item != item:
+            # hash of nan is its id
+            return 0
+        return hash(item)
+
+    stateFormat = struct.Struct('<qqdqqdqB')
+    # index is the storage kind in the checkpoint, anything else is stored as a plain dict
+    storageKinds = [CountingStorage, FenwickStorage,
+                    DictionaryEnumerator, dict, DenseStorage]
+
+    def checkpoint(self, fname: str):
+        '''
+        Write the whole state of extractor (interval, counters, flags, backlog and storage) to fname, see Checkpoint for the layout
+        '''
+        flags = self.prePost | self.storageFixed << 1 | \
+            self.revBlockAccumulating << 2 | self.revEntropyAccumulating << 3
+        sections = {}
+        sections[b'STAT'] = [Extractor.stateFormat.pack(self.base, self.outputBitsCount, self.entropyAccumulator,
+                                                        self.revBlock, self.revEntropy, self.round, self.approxLen, flags)]
+        sections[b'FRAC'] = [Checkpoint.packInt(number) for fraction in map(fr, (self.left, self.length, self.cellLeft, self.cellStep))
+                             for number in (fraction.numerator, fraction.denominator)]
+        sections[b'BLOG'] = Checkpoint.packKeys(self.backlog)
+        kind = type(self.storage)
+        kind = Extractor.storageKinds.index(
+            kind) if kind in Extractor.storageKinds else 3
+        if kind == 2:
+            ids = list(self.storage.lookup.values())
+            keys = list(self.storage.lookup)
+            counts = self.storage.values()
+            extra = [Checkpoint.packInt(self.storage.id),
+                     Checkpoint.packArray('Q', ids)]
+        else:
+            keys = list(self.storage.keys())
+            counts = list(self.storage.values())
+            extra = []
+        if any(type(count) != int for count in counts):
+            # fixed probabilities may be fractions. Same probabilities in integers:
+            denominator = lcm(*(fr(count).denominator for count in counts))
+            counts = [int(count*denominator) for count in counts]
+        sections[b'STOR'] = [bytes([kind]), Checkpoint.packArray('Q', counts)] + \
+            extra + Checkpoint.packKeys(keys)
+        if self.window or self.decay:
+            sections[b'FRGT'] = [Checkpoint.packInt(self.decayed)] + Checkpoint.packKeys(self.recent)
+        if self.quantizerState():
+            sections[b'QNTZ'] = [self.quantizer.spec.encode()] + Checkpoint.packKeys(self.quantizer.edges)
+        if self.rangeEngine:
+            sections[b'RNGE'] = [Checkpoint.packInt(self.rangeEngine.low), Checkpoint.packInt(self.rangeEngine.range),
+                                 struct.pack('<d', self.rangeEngine.lostBits)]
+        Checkpoint.write(fname, sections)
+
+    def restore(self, fname: str):
+        '''
+        Bring back the state written by checkpoint(). Base and interval engine have to match the ones of the checkpoint
+        '''
+        with Checkpoint(fname) as sections:
+            state = Extractor.stateFormat.unpack(sections[b'STAT'][0])
+            if state[0] != self.base:
+                raise ValueError(
+                    f"Checkpoint {fname} is made in base {state[0]}, not {self.base}")
+            if (b'RNGE' in sections) != bool(self.rangeEngine):
+                raise ValueError(
+                    f"Checkpoint {fname} is made with other interval engine")
+            (_, self.outputBitsCount, self.entropyAccumulator, self.revBlock,
+             self.revEntropy, self.round, self.approxLen, flags) = state
+            chunks = sections[b'STOR']
+            kind = chunks[0][0]
+            counts = Checkpoint.unpackArray('Q', chunks[1]).tolist()
+            if kind == 2:
+                # string storage means string input
+                self.convert2stringing()
+                byID = array('Q', bytes(8 * Checkpoint.unpackInt(chunks[2])))
+                ids = Checkpoint.unpackArray('Q', chunks[3]).tolist()
+                for itemid, count in zip(ids, counts):
+                    byID[itemid] = count
+                self.storage.build(
+                    dict(zip(map(sys.intern, Checkpoint.unpackKeys(chunks[4:])), ids)), byID)
+            else:
+                self.storage = Extractor.storageKinds[kind](
+                    zip(Checkpoint.unpackKeys(chunks[2:]), counts))
+            self.prePost = bool(flags & 1)
+            self.storageFixed = bool(flags & 2)
+            self.revBlockAccumulating = bool(flags & 4)
+            self.revEntropyAccumulating = bool(flags & 8)
+            numbers = [Checkpoint.unpackInt(chunk)
+                       for chunk in sections[b'FRAC']]
+            self.left, self.length, self.cellLeft, self.cellStep = (
+                fr(numbers[i], numbers[i+1]) for i in range(0, 8, 2))
+            self.backlog = Checkpoint.unpackKeys(sections[b'BLOG'])
+            if b'FRGT' in sections:
+                chunks = sections[b'FRGT']
+                self.decayed = Checkpoint.unpackInt(chunks[0])
+                self.recent = deque(Checkpoint.unpackKeys(chunks[1:]))
+            if b'QNTZ' in sections:
+                chunks = sections[b'QNTZ']
+                self.loadQuantizer({'quantize': str(chunks[0], 'utf-8'), 'edges': Checkpoint.unpackKeys(chunks[1:])})
+            if self.rangeEngine:
+                chunks = sections[b'RNGE']
+                self.rangeEngine.low = Checkpoint.unpackInt(chunks[0])
+                self.rangeEngine.range = Checkpoint.unpackInt(chunks[1])
+                self.rangeEngine.lostBits, = struct.unpack('<d', chunks[2])
+            del chunks
+
+    def feedBatch(self, batch: list, writer):
+        ''' feed() the batch of loop() to the writer and empty it
+        '''
+        if batch:
+            digits = self.feed(batch)
+            if digits and self.timed:
+                started = perf_counter()
+                writer.write(digits)
+                self.stats.seconds['io'] += perf_counter() - started
+            elif digits:
+                writer.write(digits)
+            batch.clear()
 
     def reset(self):
         '''
@@ -632,7 +2810,9 @@ class Extractor():
         '''
         # logging.debug(f"RESET")
         self.softReset(hardReset=True)
-        self.storage = {}
+        self.storage = self.newStorage()
+        self.recent.clear()
+        self.decayed = 0
         self.revBlockAccumulating = True
         self.revEntropyAccumulating = True
 
@@ -641,37 +2821,128 @@ class Extractor():
         This is a reset to allow saving of storage. This will lose some of the accumulated entropy, but will allow the fraction maths to be reset and start accumulating scary numbers again
         '''
         if not hardReset:
-            logging.debug(
-                f"Soft Reset from state: output {self.outputBitsCount}, accumulated entropy {self.entropyAccumulator:.1f}, left {self.left}, length {self.length}")
+            self.stats.softResets += 1
+            self.stats.lostEntropy += self.entropyAccumulator - self.outputBitsCount
+        if not hardReset and tracer and tracer.wants('softReset'):
+            tracer.emit('softReset', outputBits=self.outputBitsCount, entropy=self.entropyAccumulator,
+                        left=self.left, length=self.length)
         self.outputBitsCount = 0
         self.entropyAccumulator = 0
         self.left = 0
         self.length = 1
+        self.cellLeft = 0
+        self.cellStep = 1
+        self.approxLen = 0
+        if self.rangeEngine:
+            self.rangeEngine.reset()
         self.backlog = []
-        if type(self.storage) == DictionaryEnumerator:
+        # string statistics start over at a soft reset unless they are forgotten gradually
+        if type(self.storage) == DictionaryEnumerator and not (self.window or self.decay or self.maxKeys):
             self.convert2stringing()
+        if not hardReset:
+            self.forget()
+
+    # window is trimmed when it is this fraction over, and maxKeys evicts this fraction more, so that resets are rare
+    forgetSlack = 1/8
+
+    def forgetDue(self):
+        '''
+        return True when forget() has something to do. It is checked after every event, so it is O(1)
+        '''
+        return bool(self.window and len(self.recent) > self.window * (1 + self.forgetSlack) or
+                    self.decay and self.decayed >= self.decay or
+                    self.maxKeys and len(self.storage) > self.maxKeys)
+
+    def forget(self):
+        '''
+        Forget old statistics: events that went out of the window, halving of counts for decay and the rarest events over maxKeys (the oldest ones of the same count first).
+        Interval maths use storage of the events since the last soft reset, so it is done right after one: interval is reset and the backlog is empty
+        '''
+        if not self.forgetDue():
+            return
+        storage = self.storage
+        evicted = 0
+        while self.window and len(self.recent) > self.window:
+            item = self.recent.popleft()
+            count = storage.get(item)
+            if count is None:
+                continue
+            if count > 1:
+                storage[item] = count - 1
+            else:
+                del storage[item]
+                evicted += 1
+        if self.decay and self.decayed >= self.decay:
+            self.decayed = 0
+            for key in list(storage.keys()):
+                count = storage[key] // 2
+                if count:
+                    storage[key] = count
+                else:
+                    del storage[key]
+                    evicted += 1
+        if self.maxKeys and len(storage) > self.maxKeys:
+            keep = int(self.maxKeys * (1 - self.forgetSlack))
+            # sort is stable and keys are in insertion order
+            rarest = sorted(storage.keys(), key=storage.__getitem__)[:len(storage) - keep]
+            for key in rarest:
+                del storage[key]
+            evicted += len(rarest)
+            if self.window:
+                self.recent = deque(item for item in self.recent if item in storage)
+        if tracer and tracer.wants('forget'):
+            tracer.emit('forget', evicted=evicted, keys=len(storage), events=self.totalEvents())
+        # journal replays insertions only
+        if self.journal:
+            self.journal.compact(storage)
+
+    def newStorage(self, counts={}):
+        '''
+        Make an empty (or filled with counts) storage of the type set in the constructor
+        '''
+        if self.storageType == 'fenwick':
+            return FenwickStorage(counts)
+        if self.storageType == 'dense':
+            return DenseStorage(counts)
+        return CountingStorage(counts)
 
     def insert(self, *items):
         ''' Method is used for testing. To insert items without recalculating stuff in the process
         '''
         if self.storageFixed:
             return
-        logging.info("Inserting " + str(items))
+        if tracer and tracer.wants('insert'):
+            tracer.emit('insert', items=items)
         for item in items:
             if item is None:
                 continue
             if self.revBlock or self.revEntropy:
                 self.backlog.append(item)
+            if self.window:
+                self.recent.append(item)
+            if type(self.storage) == DenseStorage and self.storage.slot(item) is None:
+                self.leaveDense(item)
             # if item in self.storage:
             self.storage.setdefault(item, 0)
             self.storage[item] += 1
             # else:
             # self.storage[item] = 1
-        if self.storeStatisticsFName:
-            with open(self.storeStatisticsFName, 'wb') as outFile:
-                pickle.dump(self.storage, outFile)
+        self.decayed += len(items)
+        if self.journal:
+            self.journal.record(self.storage, items)
+
+    def leaveDense(self, item):
+        '''
+        Move the counts of DenseStorage to the dictionary storage, which keeps any number. Done before item that does not fit the dense one is inserted
+        '''
+        logging.warning(
+            f"Event {item!r} does not fit the dense storage, statistics are moved to the dictionary one")
+        self.storageType = 'dict'
+        self.storage = self.newStorage(self.storage)
 
     def totalEvents(self):
+        if isinstance(self.storage, EventCounter):
+            return self.storage.total
         # No need for special case {}
         return sum(self.storage.values())
 
@@ -694,15 +2965,357 @@ class Extractor():
     def getTotalTheoreticalEntropy(self):
         if not self.storage:
             return 0
+        if isinstance(self.storage, EventCounter):
+            return self.storage.entropy(self.base)
         # Sum of -n*log(p) in given base
-        s = sum((-1.*v*log(1.*v/self.totalEvents(), self.base)
-                 for k, v in self.storage.items()))
-        logging.debug(
-            f"Calculating entropy:\nTotal {self.totalEvents()}, base {self.base}, events:\n{self.storage}\nCalculated entropy {s}")
+        total = self.totalEvents()
+        s = sum((-1.*v*log(1.*v/total, self.base)
+                 for v in self.storage.values()))
+        if tracer and tracer.wants('entropy'):
+            tracer.emit('entropy', total=total, entropy=s)
         return s
 
 
+class InputSource():
+    '''
+    One of the inputs of Extractor.loopSources: its reader and extractor
+    '''
+    chunkSize = 1 << 16
+
+    def __init__(self, name: str, reader: ChunkReader, extractor):
+        self.name = name
+        self.reader = reader
+        self.source = reader.source
+        self.extractor = extractor
+        self.processed = 0
+
+    def process(self, text: bool = True):
+        '''
+        Read the source once and extract the events. Text lines (and records with quantization) are converted by the extractor, same as in loop()
+        return digits, see Extractor.feed()
+        '''
+        e = self.extractor
+        events = self.reader.readEvents()
+        self.processed = len(events)
+        if not text:
+            return e.feed(events)
+        digits = None
+        items = []
+        for line in events:
+            try:
+                item = e.input2object(line)
+            except ValueError:
+                digits = e.feed(items)
+                items = []
+                e.convert2stringing()
+                item = e.input2object(line)
+            if item is not None:
+                items.append(item)
+        if digits is None:
+            return e.feed(items)
+        digits.extend(e.feed(items))
+        return digits
+
+
+class EntropyPool():
+    '''
+    Blocking source of random bytes for library use and for EntropyService: extractor loop() runs in a background thread and writes packed output to a ring buffer of capacity bytes, waiting while it is full.
+    read(n) waits for bytes, tryRead(n) does not, available() is the number of bytes ready. Extractor output (outp, outputFormat and the flush policy) is taken over by the pool
+    onChange is called in the extractor thread when bytes are written and when input is over, so that a reader of another thread or an asyncio loop can wake up
+    '''
+
+    def __init__(self, extractor, capacity: int = 1 << 16, onChange: callable = None):
+        assert extractor.base & (extractor.base - 1) == 0, "Pool of bytes needs a power of two base"
+        self.extractor = extractor
+        self.ring = bytearray(capacity)
+        self.start = 0
+        self.size = 0
+        # bytes given back by unread(), handed out before the ring
+        self.spare = bytearray()
+        self.onChange = onChange
+        # input is over or pool is closed
+        self.finished = False
+        self.closed = False
+        self.changed = threading.Condition()
+        extractor.outp = self
+        extractor.outputFormat = 'binary'
+        if not (extractor.flushBytes or extractor.flushEvents or extractor.flushMs):
+            extractor.flushBytes, extractor.flushMs = 64, 20
+        self.thread = threading.Thread(target=self.ingest, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def ingest(self):
+        try:
+            self.extractor.loop()
+        except BrokenPipeError:
+            # closed by the consumer
+            pass
+        except Exception:
+            logging.exception("Extraction of the entropy pool failed")
+        finally:
+            with self.changed:
+                self.finished = True
+                self.changed.notify_all()
+            if self.onChange:
+                self.onChange()
+
+    def write(self, data: bytes):
+        '''
+        Output of the extractor thread
+        '''
+        view = memoryview(data)
+        capacity = len(self.ring)
+        with self.changed:
+            while view:
+                self.changed.wait_for(
+                    lambda: self.size < capacity or self.closed)
+                if self.closed:
+                    raise BrokenPipeError("Entropy pool is closed")
+                end = (self.start + self.size) % capacity
+                taken = min(len(view), capacity - self.size, capacity - end)
+                self.ring[end:end + taken] = view[:taken]
+                self.size += taken
+                view = view[taken:]
+                self.changed.notify_all()
+                if self.onChange:
+                    self.onChange()
+
+    def flush(self):
+        return
+
+    def take(self, n: int):
+        ''' return up to n bytes from the spare ones and the ring. Caller holds self.changed
+        '''
+        spare = bytes(self.spare[:n])
+        del self.spare[:n]
+        capacity = len(self.ring)
+        n = min(n - len(spare), self.size)
+        end = self.start + n
+        data = spare + bytes(self.ring[self.start:min(end, capacity)]) + \
+            bytes(self.ring[:max(0, end - capacity)])
+        self.start = end % capacity
+        self.size -= n
+        self.changed.notify_all()
+        return data
+
+    def unread(self, data: bytes):
+        '''
+        Give back bytes that were read but never handed out, they are read first. They do not count against the capacity
+        '''
+        with self.changed:
+            self.spare[:0] = data
+            self.changed.notify_all()
+
+    def read(self, n: int, timeout: float = None):
+        '''
+        return n bytes, fewer only when timeout seconds passed or input is over. None timeout waits forever
+        '''
+        data = bytearray()
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.changed:
+            while len(data) < n:
+                left = None if deadline is None else deadline - monotonic()
+                if not self.changed.wait_for(lambda: self.available() or self.finished, left) or not self.available():
+                    break
+                data += self.take(n - len(data))
+        return bytes(data)
+
+    def tryRead(self, n: int):
+        '''
+        return n bytes if they are ready, None otherwise
+        '''
+        with self.changed:
+            if self.available() < n:
+                return None
+            return self.take(n)
+
+    def available(self):
+        return self.size + len(self.spare)
+
+    def close(self):
+        '''
+        Stop the extraction. It ends at the next output write, input that blocks keeps the thread until it gives an event
+        '''
+        with self.changed:
+            self.closed = True
+            self.finished = True
+            self.changed.notify_all()
+
+
+class EntropyService():
+    '''
+    EntropyPool of the extractor and asyncio servers handing its bytes out to clients.
+    Protocol: client sends a request of 4 bytes, big-endian number of bytes wanted. Response is 4 bytes of big-endian length and the bytes. Length is short of the request only when the extractor input is over, so a zero length is the end of service.
+    Requests over maxRequest close the connection. Bytes taken for a client that has closed the connection go back to the pool. Bytes of a response that fails to be sent are dropped: they are never handed out twice
+    '''
+    maxRequest = 1 << 24
+
+    def __init__(self, extractor, poolBytes: int = 1 << 20):
+        assert extractor.base & (extractor.base - 1) == 0, "Service of bytes needs a power of two base"
+        self.extractor = extractor
+        self.poolBytes = poolBytes
+        self.pool = None
+        self.clients = 0
+        # set from the extractor thread on every change of the pool
+        self.changed = None
+        # readers are served one at a time in the order of arrival, so a big request does not starve behind small ones
+        self.reading = None
+
+    async def run(self, unixPath: str = None, tcp: str = None):
+        '''
+        Serve on the unix socket path and/or [host:]port of tcp until cancelled
+        '''
+        loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.reading = asyncio.Lock()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(self.changed.set)
+            except RuntimeError:
+                # the loop is closed, nobody waits
+                pass
+        servers = []
+        if unixPath:
+            # left by a previous run
+            EntropyService.removeSocket(unixPath)
+            servers.append(await asyncio.start_unix_server(self.handle, unixPath))
+        if tcp:
+            host, _, port = tcp.rpartition(':')
+            servers.append(await asyncio.start_server(self.handle, host or '127.0.0.1', int(port)))
+        e = self.extractor
+        if not (e.flushBytes or e.flushEvents or e.flushMs):
+            # a write to the pool crosses threads, so it is not done for every event
+            e.flushBytes, e.flushMs = 4096, 20
+        self.pool = EntropyPool(e, self.poolBytes, wake)
+        logging.info(f"Serving on {unixPath or ''} {tcp or ''}")
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            if self.pool:
+                self.pool.close()
+            for server in servers:
+                server.close()
+            if unixPath:
+                EntropyService.removeSocket(unixPath, strict=False)
+
+    @staticmethod
+    def removeSocket(path: str, strict: bool = True):
+        '''
+        Remove the unix socket at path if there is one. Anything else at path is kept: FileExistsError is raised if strict
+        '''
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            return
+        if stat.S_ISSOCK(mode):
+            os.remove(path)
+        elif strict:
+            raise FileExistsError(f"{path} exists and is not a socket")
+
+    async def read(self, n: int, gone: callable):
+        '''
+        return n bytes of the pool, fewer only when the input is over or gone() is true
+        '''
+        data = bytearray()
+        async with self.reading:
+            while len(data) < n and not gone():
+                self.changed.clear()
+                data += self.pool.read(n - len(data), timeout=0)
+                if len(data) < n:
+                    if self.pool.finished and not self.pool.available():
+                        break
+                    await self.changed.wait()
+        return bytes(data)
+
+    async def handle(self, reader, writer):
+        self.clients += 1
+        try:
+            while True:
+                n = int.from_bytes(await reader.readexactly(4), 'big')
+                if n > EntropyService.maxRequest:
+                    logging.warning(f"Request of {n} bytes is over the limit, closing the connection")
+                    break
+                data = await self.read(n, reader.at_eof)
+                if reader.at_eof():
+                    # client is gone while its bytes were gathered, they were not sent to anyone
+                    self.pool.unread(data)
+                    break
+                writer.write(len(data).to_bytes(4, 'big') + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+
+def serve(extractor, unixPath: str = None, tcp: str = None, poolBytes: int = 1 << 20):
+    '''
+    Run EntropyService of the extractor until interrupted
+    '''
+    try:
+        asyncio.run(EntropyService(extractor, poolBytes).run(unixPath, tcp))
+    except KeyboardInterrupt:
+        pass
+
+
+def blockDigits(items: list, probs: dict, base: int = 2):
+    '''
+    Digits of a block of Extractor.loopBlocks: the deepest cell containing the interval of the events with frozen probabilities.
+    probs   -   (probability, probability of smaller) of every event of the block, see Extractor.getProbs. None is the counts of the block itself
+    return bytearray or array('L') for bases over 256, same as Extractor.feed()
+    '''
+    output = bytearray() if base <= 256 else array('L')
+    if probs is None:
+        # getProbs of an ordered storage costs O(log n) per key
+        storage = FenwickStorage(Extractor.history2storage(items))
+        probs = {key: storage.getProbs(key) for key in storage}
+    updates = {}
+    for key, (probability, probSmallerThan) in probs.items():
+        probability, probSmallerThan = fr(probability), fr(probSmallerThan)
+        if probability:
+            denominator = lcm(probability.denominator,
+                              probSmallerThan.denominator)
+            updates[key] = (probSmallerThan.numerator * (denominator // probSmallerThan.denominator),
+                            probability.numerator * (denominator // probability.denominator), denominator)
+    maps = [updates[item] for item in items if item in updates]
+    if maps:
+        left, length, denominator = Extractor.composeIntervals(maps)
+        index, digits = Extractor.cellDigits(
+            left, left + length, denominator, base)
+        output.extend(Extractor.indexDigits(index, digits, base))
+    return output
+
+
+def shardWorker(params: dict, inbox, outbox):
+    '''
+    Worker process of Extractor.loopSharded: feed() the event lists from inbox to own extractor and put the digits to outbox. None stops it
+    '''
+    e = Extractor(**params)
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        if message == Extractor.shardConvert:
+            e.convert2stringing()
+            continue
+        outbox.put(e.feed(message))
+    if e.journal:
+        e.journal.close()
+
+
 if __name__ == "__main__":
     params = init()
+    service = params.pop('service')
     e = Extractor(**params)
-    e.loop()
+    if service:
+        serve(e, **service)
+    else:
+        e.loop()
@@ -4,9 +4,20 @@ import unittest
 import mrge
 from fractions import Fraction as fr
 import os
+import contextlib
+import shutil
+import tempfile
 
 
 class testMRGE(unittest.TestCase):
+    def tempName(self, name: str):
+        '''
+        return path of name in a new directory that is removed after the test, with the journals and everything else made next to name
+        '''
+        directory = tempfile.mkdtemp(prefix='mrge-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return os.path.join(directory, name)
+
     def testDummy(self):
         assert True, "Things are really bad. Get a break"
 
@@ -306,6 +317,8 @@ class testMRGE(unittest.TestCase):
         eout.insert(1, 2, 3, 4)
         ein = mrge.Extractor(loadStats=".test.pickle")
         assert ein.storage == {1: 1, 2: 1, 3: 1, 4: 1}, "Bad pickle"
+        for suffix in ("", ".journal"):
+            os.remove(".test.pickle" + suffix)
 
     def testBlock(self):
         revlen = 4
@@ -548,6 +561,35 @@ class testMRGE(unittest.TestCase):
         assert cd.get('e', 55) == 3 and cd.get('z', 55) == 55, \
             "Bad get of enum dicti"
 
+    def testEnumeratorIndex(self):
+        import pickle
+        import random
+        rnd = random.Random(12)
+        storage = mrge.DictionaryEnumerator()
+        storage.compactSlack = 16
+        for _ in range(3000):
+            x = str(rnd.randint(0, 300))
+            storage.setdefault(x, 0)
+            storage[x] += 1
+            if rnd.random() < .3:
+                del storage[rnd.choice(list(storage.keys()))]
+        assert len(storage.counts) < 2 * len(storage) + 16, "Ids of deleted items are kept"
+        ids = [storage.getID(key) for key in storage.keys()]
+        assert ids == sorted(ids), "Renumbering changed the order of items"
+        for key in storage.keys():
+            lessThan = sum(storage[k]
+                           for k in storage.keys() if storage.getID(k) < storage.getID(key))
+            assert storage.getProbs(key) == (fr(storage[key], storage.total), fr(lessThan, storage.total))
+        assert storage.getProbs('new') == (0, 1)
+        # pickles of the dictionary counts version
+        legacy = mrge.DictionaryEnumerator.__new__(mrge.DictionaryEnumerator)
+        legacy.__setstate__({'id': 3, 'lookup': {'a': 0, 'c': 2}, 'count': {0: 2, 2: 5},
+                             'total': 7, 'nlogn': 0.})
+        assert storage.setdefault('fresh') == 0 and storage['fresh'] == 0, "setdefault does not return the stored count"
+        assert legacy['c'] == 5 and legacy.total == 7 and legacy.getProbs('c') == (fr(5, 7), fr(2, 7))
+        restored = pickle.loads(pickle.dumps(storage))
+        assert restored == storage and restored.getProbs(key) == storage.getProbs(key)
+
     # TODO: add reset test
     def testConversionToStringAcceptingInput(self):
         e = mrge.Extractor()
@@ -604,6 +646,754 @@ class testMRGE(unittest.TestCase):
             succ, bits = e.next2(t)
             assert succ and bits == [0], "Fixed with given dicti does not work"
 
+    def testFenwickStorage(self):
+        import random
+        rnd = random.Random(7)
+        fs = mrge.FenwickStorage()
+        plain = {}
+        for _ in range(3000):
+            x = rnd.randint(0, 1500)
+            fs.setdefault(x, 0)
+            fs[x] += 1
+            plain.setdefault(x, 0)
+            plain[x] += 1
+        assert fs == plain and fs.total == sum(plain.values()),\
+            "Fenwick storage lost counts"
+        for x in [-1, 0, 3, 700, 1500, 1501, 2.5]:
+            assert mrge.Extractor.getProbs(x, fs) == mrge.Extractor.getProbs(x, plain),\
+                "Fenwick storage gives other probabilities for "+str(x)
+        for x in list(plain)[::3]:
+            del fs[x]
+            del plain[x]
+        # whole blocks go away
+        for x in [x for x in plain if 100 <= x < 600]:
+            del fs[x]
+            del plain[x]
+        for x in range(-1, 1502, 7):
+            assert mrge.Extractor.getProbs(x, fs) == mrge.Extractor.getProbs(x, plain),\
+                "Bad probabilities after deletion from Fenwick storage"
+        inp = [rnd.random() for _ in range(30)]*2
+        e = mrge.Extractor(storageType='fenwick', rounding=.1)
+        e1 = mrge.Extractor(rounding=.1)
+        for x in inp:
+            assert e.next2(x) == e1.next2(x), "Fenwick storage changed the output"
+        e = mrge.Extractor(saveStats=".test.pickle", storageType='fenwick')
+        e.insert(3, 1, 2)
+        ein = mrge.Extractor(loadStats=".test.pickle", storageType='fenwick')
+        assert type(ein.storage) == mrge.FenwickStorage and ein.storage == {1: 1, 2: 1, 3: 1},\
+            "Bad pickle of Fenwick storage"
+        assert ein.storage.getProbs(3) == (fr(1, 3), fr(2, 3))
+        for suffix in ("", ".journal"):
+            os.remove(".test.pickle" + suffix)
+
+    def testRunningCounters(self):
+        from math import log
+        import pickle
+        import random
+        rnd = random.Random(3)
+        for storage in (mrge.CountingStorage(), mrge.FenwickStorage(), mrge.DictionaryEnumerator()):
+            for _ in range(500):
+                x = str(rnd.randint(0, 40))
+                storage.setdefault(x, 0)
+                storage[x] += 1
+            del storage['7']
+            counts = [storage[k] for k in storage.keys()]
+            total = sum(counts)
+            ent = sum(-c*log(c/total, 3) for c in counts)
+            assert storage.total == total, "Bad running total of " + \
+                str(type(storage))
+            assert abs(storage.entropy(3) - ent) < 1e-9,\
+                "Bad running entropy of "+str(type(storage))
+            restored = pickle.loads(pickle.dumps(storage))
+            assert restored == storage and restored.total == total,\
+                "Bad pickle of "+str(type(storage))
+
+    def testIncrementalApproximation(self):
+        import random
+        rnd = random.Random(11)
+        for base in (2, 3, 10):
+            e = mrge.Extractor(base=base, revEntropy=5)
+            out = []
+            for _ in range(150):
+                succ, digits = e.next2(rnd.choice([1, 2, 2, 3, 7, 7, 7]))
+                out += digits
+                assert e.approximationDigits() == e.generateOutputApproximation2(),\
+                    "Incremental approximation went off the full one in base "+str(base)
+            assert out == e.generateOutputApproximation2()[-len(out):],\
+                "Emitted digits are not the approximation in base "+str(base)
+
+    def testRangeEngine(self):
+        import random
+        rnd = random.Random(5)
+        inp = [rnd.choice([0, 1, 1, 2, 3, 3, 3, 3]) for _ in range(3000)]
+        for engine, base in (('range32', 2), ('range64', 2), ('range32', 7)):
+            e = mrge.Extractor(engine=engine, base=base)
+            out = []
+            for x in inp:
+                out += e.next2(x)[1]
+            assert all(0 <= d < base for d in out), "Bad digits of "+engine
+            # Interval that is not emitted yet holds less than 32 bits
+            ent = e.entropyAccumulator
+            assert ent - 32 < len(out) + e.getLostEntropy() <= ent + 1e-6,\
+                f"Range engine {engine} lost track of entropy {len(out)}+{e.getLostEntropy()} of {ent}"
+            assert -0.01 < e.getLostEntropy() < 1, "Too much entropy lost by "+engine
+        e = mrge.Extractor(engine='range32', revBlock=4)
+        for i in range(3):
+            assert e.next2(i) == (False, []), "Range engine released block early"
+        succ, bits = e.next2(3)
+        assert succ and len(bits) == 8, "Bad block release of range engine "+str(bits)
+
+    def testBudgetReset(self):
+        import random
+        rnd = random.Random(9)
+        e = mrge.Extractor(maxFractionBits=64)
+        out = []
+        for _ in range(500):
+            out += e.next2(rnd.randint(0, 9))[1]
+            assert e.left.denominator.bit_length() <= 64 and e.length.denominator.bit_length() <= 64,\
+                "Fractions outgrew the budget "+str(e.length)
+        assert len(out) > 1000, "Budget resets ate the output "+str(len(out))
+        e = mrge.Extractor(maxEventUs=1e-3)
+        e.next2(1)
+        e.next2(2)
+        assert e.left == 0 and e.length == 1 and e.entropyAccumulator == 0,\
+            "No soft reset after a slow event"
+        e = mrge.Extractor(maxEventUs=1e-3, revBlock=3)
+        e.next2(1)
+        e.next2(2)
+        assert e.backlog == [1, 2], "Budget reset dropped the backlog"
+
+    def testStatsJournal(self):
+        import pickle
+        fname = ".test.journal.pickle"
+        e = mrge.Extractor(saveStats=fname, compactEvents=3)
+        for x in [1, 2, 2, 3, 3, 3, 4]:
+            e.insert(x)
+        ein = mrge.Extractor(loadStats=fname)
+        assert ein.storage == {1: 1, 2: 2, 3: 3, 4: 1}, \
+            "Journal tail is not replayed "+str(ein.storage)
+        # snapshot loads without mrge classes, e.g. when written by the script as __main__
+        with open(fname, 'rb') as snapshot:
+            assert type(pickle.load(snapshot)) == dict, "Snapshot is not a plain dictionary"
+        assert type(mrge.Extractor(loadStats=fname, storageType='fenwick').storage) == mrge.FenwickStorage
+        # record cut by a crash is ignored
+        e.insert(5)
+        with open(fname + ".journal", 'ab') as journal:
+            journal.write(b'\x80\x04\x95')
+        ein = mrge.Extractor(loadStats=fname)
+        assert ein.storage == {1: 1, 2: 2, 3: 3, 4: 1, 5: 1}, \
+            "Broken journal tail is not skipped "+str(ein.storage)
+        # replaced storage is snapshotted, old journal is not replayed on top of it
+        e.convert2stringing()
+        e.insert('a')
+        ein = mrge.Extractor(loadStats=fname)
+        assert type(ein.storage) == mrge.DictionaryEnumerator and ein.storage['a'] == 1 and len(ein.storage) == 1, \
+            "Bad snapshot of replaced storage"
+        for suffix in ("", ".journal"):
+            os.remove(fname + suffix)
+
+    def testForgetting(self):
+        import random
+        from math import log
+        rand = random.Random(10)
+        data = [min(int(rand.expovariate(.02)), 255) for i in range(3000)]
+        for storageType, str2cmp in [('dict', float), ('fenwick', float), ('dense', float), ('dict', str)]:
+            for mode, value in [('window', 500), ('decay', 500), ('maxKeys', 40)]:
+                e = mrge.Extractor(storageType=storageType,
+                                   str2cmp=str2cmp, **{mode: value})
+                resets = 0
+                for x in data:
+                    total = e.totalEvents()
+                    e.next2(e.input2object(str(x)))
+                    if e.stats.softResets == resets:
+                        assert e.totalEvents() == total + 1, f"{storageType} {str2cmp} {mode}: statistics changed without soft reset"
+                    resets = e.stats.softResets
+                    assert not e.backlog
+                assert resets > 0, f"{storageType} {mode}: nothing forgotten"
+                counts = [e.storage[key] for key in e.storage.keys()]
+                assert all(counts) and sum(counts) == e.totalEvents(), \
+                    f"{storageType} {str2cmp} {mode}: bad totals after eviction"
+                total = sum(counts)
+                entropy = sum(-n * log(n / total, 2) for n in counts)
+                assert abs(e.getTotalTheoreticalEntropy() - entropy) < 1e-6 * total, \
+                    f"{storageType} {str2cmp} {mode}: bad entropy after eviction"
+                if mode == 'window':
+                    assert total == len(e.recent) <= value * (1 + e.forgetSlack)
+                elif mode == 'decay':
+                    assert e.decayed < value and total < 2 * value
+                else:
+                    assert len(e.storage) <= value
+        # window goes through a checkpoint
+        fname = ".test.forget.checkpoint"
+        e = mrge.Extractor(window=100)
+        for x in data[:250]:
+            e.next2(x)
+        e.checkpoint(fname)
+        ein = mrge.Extractor(window=100, restoreFName=fname)
+        os.remove(fname)
+        assert list(ein.recent) == list(e.recent) and ein.storage == e.storage
+
+    def testQuantize(self):
+        import io
+        import random
+        rand = random.Random(11)
+        values = [rand.gauss(0, 10) for i in range(3000)]
+        lines = [repr(x) for x in values]
+        q = mrge.Quantizer('step:0.5')
+        assert [q(x) for x in ['0.2', '0.5', '-0.2', '7']] == [0, 1, -1, 14]
+        q = mrge.Quantizer('sig:2')
+        assert q('123.4') == q('120') != q('130') and q('0') == 0 and q('-1') < 0 < q('0.001') < q('1')
+        ids = [q(x) for x in sorted(values)]
+        assert ids == sorted(ids), "Bin ids are not in the order of values"
+        self.assertRaises(ValueError, mrge.Quantizer, 'bins:4')
+        for spec, keys in [('step:1', 80), ('sig:1', 100), ('bins:16:500', 16)]:
+            out = io.StringIO()
+            e = mrge.Extractor(instream=lines, quantize=spec)
+            e.outp = out
+            e.loop()
+            assert 0 < len(e.storage) <= keys and all(type(key) == int for key in e.storage), f"{spec}: {len(e.storage)} keys"
+            warmup = 500 if spec.startswith('bins') else 0
+            assert e.totalEvents() == len(lines) - warmup and len(out.getvalue()) > 0
+            if warmup:
+                counts = sorted(e.storage.values())
+                assert counts[-1] < 3 * counts[0], "Bins are not of equal frequency " + str(counts)
+        # not a number falls back to strings as before
+        e = mrge.Extractor(instream=lines[:10] + ['word'], quantize='step:1')
+        e.outp = io.StringIO()
+        e.loop()
+        assert 'word' in e.storage
+        # fitted edges are saved with the statistics and the checkpoint, warm-up is not repeated
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            stats, checkpoint = os.path.join(d, 'quantize.pickle'), os.path.join(d, 'quantize.checkpoint')
+            e = mrge.Extractor(instream=lines[:1000], quantize='bins:16:500', saveStats=stats, checkpointFName=checkpoint)
+            e.outp = io.StringIO()
+            e.loop()
+            for kwargs in [{'loadStats': stats}, {'restoreFName': checkpoint}]:
+                resumed = mrge.Extractor(instream=lines[1000:1100], quantize='bins:16:500', **kwargs)
+                resumed.outp = io.StringIO()
+                resumed.loop()
+                assert resumed.quantizer.edges == e.quantizer.edges and resumed.totalEvents() == 600, \
+                    f"Quantizer warms up again with {kwargs}"
+            assert mrge.Extractor(quantize='bins:8:500', loadStats=stats).quantizer.edges is None, "Edges of another spec are used"
+        # dense storage is picked only for the bounded bin ids
+        for spec, kind in [('sig:2', mrge.CountingStorage), ('step:0.5', mrge.CountingStorage), ('bins:4:8', mrge.DenseStorage)]:
+            e = mrge.Extractor(instream=[rand.randrange(1 << 16) for i in range(100)], inputFormat='u16le', storageType='auto', quantize=spec)
+            e.outp = io.StringIO()
+            e.loop()
+            assert type(e.storage) == kind and e.totalEvents() > 0, f"Bad storage for {spec}"
+
+    def testCheckpoint(self):
+        import random
+        fname = ".test.checkpoint"
+        rand = random.Random(7)
+        data = [rand.choice([1, 2, 3, 4.5]) for i in range(60)]
+        words = [rand.choice(['a', 'b', 'c\0d', 'ё']) for i in range(60)]
+        for kwargs, inputs in [({}, data), ({'rounding': .1}, data), ({'revEntropy': 8}, data), ({'storageType': 'fenwick'}, data),
+                               ({'engine': 'range32', 'revBlock': 5}, data), ({'str2cmp': str}, words), ({'fixed': {0: fr(1, 3), 1: fr(2, 3)}}, [0, 1]*30)]:
+            whole = mrge.Extractor(**kwargs)
+            first = mrge.Extractor(**kwargs)
+            wholeOut, cutOut = [], []
+            for i, x in enumerate(inputs):
+                wholeOut.extend(whole.next2(x)[1])
+                if i < 37:
+                    cutOut.extend(first.next2(x)[1])
+                    continue
+                if i == 37:
+                    first.checkpoint(fname)
+                    second = mrge.Extractor(**kwargs, restoreFName=fname)
+                cutOut.extend(second.next2(x)[1])
+            assert wholeOut == cutOut, f"Restored extractor differs with {kwargs}"
+            # fixed fractions come back scaled to integers
+            assert type(second.storage) == type(whole.storage) and \
+                all(second.getProbs(x, second.storage) == whole.getProbs(x, whole.storage) for x in set(inputs)), \
+                f"Bad restored storage with {kwargs}"
+        with self.assertRaises(ValueError):
+            mrge.Extractor(base=3, restoreFName=fname)
+        os.remove(fname)
+
+    def testPeriodicCheckpoint(self):
+        import io
+        import random
+        import tempfile
+        rand = random.Random(3)
+        lines = [str(rand.choice([1, 2, 3, 4.5])) for i in range(100)]
+
+        def crashing():
+            yield from lines[:67]
+            raise KeyboardInterrupt
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, 'periodic.checkpoint')
+            for kwargs in [{}, {'batchSize': 7}, {'engine': 'range32'}]:
+                whole = mrge.Extractor(instream=lines, **kwargs)
+                whole.outp = io.StringIO()
+                whole.loop()
+                first = mrge.Extractor(instream=crashing(), checkpointFName=fname, checkpointEvents=20,
+                                       flushBytes=1 << 20, **kwargs)
+                first.outp = io.StringIO()
+                with self.assertRaises(KeyboardInterrupt):
+                    first.loop()
+                second = mrge.Extractor(instream=lines[60:], restoreFName=fname, **kwargs)
+                second.outp = io.StringIO()
+                second.loop()
+                assert first.outp.getvalue() + second.outp.getvalue() == whole.outp.getvalue(), \
+                    f"Resumed output differs from the whole one with {kwargs}"
+
+    def testLineReader(self):
+        import io
+        text = 'ё1\r\n\n 2.5 \n\n\n\n3\n' + 'ё'*10 + '\n  \nlast'
+        expected = ['ё1', '2.5', '3', 'ё'*10, 'last']
+        for chunkSize in (1, 2, 3, 7, 1000):
+            reader = mrge.LineReader(io.BytesIO(text.encode()), chunkSize)
+            assert list(reader) == expected, f"Bad lines with chunk {chunkSize}"
+        fname = self.tempName('lines')
+        with open(fname, 'w') as outFile:
+            outFile.write('1\n\n2\n1\n')
+        e = mrge.Extractor(inp=fname)
+        e.loop()
+        assert e.storage == {1.: 2, 2.: 1}, "Blank line stopped file input"
+
+    def testRecordReader(self):
+        import io
+        import struct
+        values = [0.5, -1.25, 3., 1e300]
+        raw = struct.pack('<4d', *values)
+        for chunkSize in (3, 8, 13, 1000):
+            reader = mrge.RecordReader(io.BytesIO(raw + b'\1\2'), 'f64le', chunkSize)
+            assert list(reader) == values, f"Bad records with chunk {chunkSize}"
+        assert list(mrge.RecordReader(io.BytesIO(struct.pack('<3H', 1, 513, 65535)), 'u16le')) == [1, 513, 65535]
+        fname = self.tempName('records')
+        with open(fname, 'wb') as outFile:
+            outFile.write(bytes([7, 0, 7, 255, 0]))
+        e = mrge.Extractor(inp=fname, inputFormat='u8', str2cmp=str)
+        e.loop()
+        assert e.storage == {0: 2, 7: 2, 255: 1} and type(e.storage) != mrge.DictionaryEnumerator, \
+            "Bad binary input storage"
+
+    def testOutputWriter(self):
+        import io
+        out = io.BytesIO()
+        writer = mrge.OutputWriter(out, 2, 'binary', flushBytes=2)
+        writer.write([1, 0, 1])
+        writer.write([0, 0, 0, 0, 1, 1, 1, 1, 1])
+        assert out.getvalue() == b'', "Flushed before flushBytes"
+        writer.write([1, 1, 1, 1, 1, 1, 1, 1, 0, 1])
+        assert out.getvalue() == bytes([0b10100001, 0b11111111]), "Bad packed bytes"
+        writer.write([1, 1, 0])
+        writer.close()
+        assert out.getvalue()[2] == 0b11110111, "Bad packed bytes"
+        writer.write([1])
+        writer.close()
+        assert len(out.getvalue()) == 3, "Partial byte is written"
+        out = io.BytesIO()
+        writer = mrge.OutputWriter(out, 16, 'binary')
+        writer.write([15, 0, 10])
+        writer.close()
+        assert out.getvalue() == bytes([0xf0]), "Bad packed base 16"
+        out = io.StringIO()
+        writer = mrge.OutputWriter(out, 3, flushEvents=2)
+        writer.write([2, 0])
+        assert out.getvalue() == ''
+        writer.write([1])
+        assert out.getvalue() == '201', "Bad text output"
+
+
+    def testFeed(self):
+        import random
+        rand = random.Random(5)
+        data = [rand.choice([1, 2, 3, 4.5, 7]) for i in range(80)]
+        for kwargs, inputs in [({}, data), ({'base': 3}, data), ({'rounding': .1}, data), ({'revEntropy': 8}, data), ({'preNotPostRecalc': False}, data),
+                               ({'engine': 'range32'}, data), ({'fixed': {0: fr(1, 3), 1: fr(2, 3)}}, [0, 1, 1]*20), ({'str2cmp': str}, list(map(str, data)))]:
+            single = mrge.Extractor(**kwargs)
+            batched = mrge.Extractor(**kwargs)
+            expected = [digit for x in inputs for digit in single.next2(x)[1]]
+            output = bytearray()
+            for start, end in [(0, 1), (1, 2), (2, 30), (30, 31), (31, len(inputs))]:
+                output += batched.feed(iter(inputs[start:end]))
+            assert list(output) == expected, f"Batch output differs with {kwargs}"
+            assert batched.outputBitsCount == single.outputBitsCount
+        assert type(mrge.Extractor(base=1000).feed([1, 2])) == mrge.array
+        # integer digit search agrees with the Fraction one, ends on the edges of cells included
+        for base in (2, 3, 10):
+            for left, right, denominator in [(0, 1, 1), (1, 2, 4), (3, 4, 4), (0, 1, 9), (1, 3, 9), (2, 3, 9), (5, 6, 27), (1, 2, 1000), (999, 1000, 1000)] + \
+                    [(x, x + rand.randint(1, 10**6), 10**12) for x in (rand.randint(0, 10**12 - 10**6) for i in range(30))]:
+                index, length = mrge.Extractor.cellDigits(
+                    left, right, denominator, base)
+                assert mrge.Extractor.indexDigits(index, length, base) == \
+                    mrge.Extractor.extendApproximation(fr(left, denominator), fr(right, denominator), base)[0], \
+                    f"Bad digits of {left}..{right}/{denominator} in base {base}"
+        # fractions are kept under the budget between the batches, so the cost of a batch does not grow with the feed
+        import time
+        timings = []
+        for kwargs, n in [({}, 3000), ({}, 30000), ({'maxFractionBits': 256}, 3000)]:
+            e = mrge.Extractor(**kwargs)
+            started = time.perf_counter()
+            for start in range(0, n, 100):
+                e.feed([rand.randrange(16) for i in range(100)])
+            timings.append(time.perf_counter() - started)
+            assert e.left.denominator.bit_length() <= (e.maxFractionBits or mrge.Extractor.batchFractionBits), \
+                f"Fractions over the budget with {kwargs}"
+        assert timings[1] < 30 * timings[0], f"Feed slows down superlinearly: {timings}"
+        fname = self.tempName('feed.pickle')
+        e = mrge.Extractor(saveStats=fname)
+        e.feedMany(data[:40])
+        e.feedMany(data[40:])
+        e.journal.close()
+        assert mrge.Extractor(loadStats=fname).storage == e.storage, "Batch is not journaled"
+
+    def testFixedEngine(self):
+        import random
+        rand = random.Random(11)
+        fixed = {0: fr(1, 6), 1: fr(1, 2), 2.5: fr(1, 3)}
+        data = [rand.choice([0, 1, 1, 1, 2.5, 2.5, 7]) for i in range(1500)]
+        single = mrge.Extractor(fixed=fixed)
+        expected = [digit for x in data for digit in single.next2(x)[1]]
+        batched = mrge.Extractor(fixed=fixed)
+        output = batched.feed(data[:1]) + batched.feed(data[1:700]) + batched.feed(iter(data[700:]))
+        assert list(output) == expected, "Fixed batch output differs from next2"
+        assert abs(batched.entropyAccumulator - single.entropyAccumulator) < 1e-6
+        engine = mrge.FixedEngine(fixed)
+        updates, entropy = engine.updates([2.5, 7, 0])
+        assert updates == [(4, 2, 6), (0, 1, 6)], "Bad integer updates " + str(updates)
+        # loaded storage changes, engine follows it
+        batched.storage = {0: 1, 1: 1}
+        batched.feed([1])
+        assert batched.fixedEngine.storage is batched.storage, "Engine of the old storage is used"
+
+    def testDenseStorage(self):
+        import random
+        rnd = random.Random(13)
+        ds = mrge.DenseStorage()
+        plain = {}
+        for _ in range(2000):
+            x = rnd.randint(0, 300)
+            ds.setdefault(x, 0)
+            ds[x] += 1
+            plain.setdefault(x, 0)
+            plain[x] += 1
+        assert ds == plain and len(ds) == len(plain) and ds.total == sum(plain.values()), \
+            "Dense storage lost counts"
+        for x in [-1, 0, 3, 255, 256, 300, 301, 70000, 2.5]:
+            assert mrge.Extractor.getProbs(x, ds) == mrge.Extractor.getProbs(x, plain), \
+                "Dense storage gives other probabilities for "+str(x)
+        with self.assertRaises(ValueError):
+            ds[2.5] = 1
+        inp = [rnd.randint(0, 20) for _ in range(60)]
+        e = mrge.Extractor(storageType='dense', rounding=.1)
+        e1 = mrge.Extractor(rounding=.1)
+        for x in inp:
+            assert e.next2(x) == e1.next2(x), "Dense storage changed the output"
+        # events out of its range move the counts to the dictionary storage midway
+        import io
+        lines = [str(x) for x in inp[:30]] + ['70000', '-3', '2.5', 'inf'] + [str(x) for x in inp[30:]]
+        outputs = []
+        for storageType in ('dense', 'dict'):
+            e = mrge.Extractor(instream=lines, storageType=storageType)
+            e.outp = io.StringIO()
+            with self.assertLogs(level='WARNING') if storageType == 'dense' else contextlib.nullcontext():
+                e.loop()
+            outputs.append(e.outp.getvalue())
+            assert e.totalEvents() == len(lines) and type(e.storage) == mrge.CountingStorage
+        assert outputs[0] == outputs[1], "Fallback from the dense storage changed the output"
+        fname = self.tempName('dense.pickle')
+        e = mrge.Extractor(saveStats=fname, storageType='dense')
+        e.insert(3, 1, 2, 3)
+        e.journal.close()
+        ein = mrge.Extractor(loadStats=fname, storageType='dense')
+        assert type(ein.storage) == mrge.DenseStorage and ein.storage == {1: 1, 2: 1, 3: 2}, \
+            "Bad pickle of dense storage"
+        e.checkpoint(fname)
+        assert mrge.Extractor(restoreFName=fname).storage == e.storage, "Bad checkpoint of dense storage"
+
+    def testTracer(self):
+        import io
+        import json
+        out = io.StringIO()
+        mrge.tracer = mrge.Tracer(out, ['next2', 'insert'], sample=2)
+        try:
+            e = mrge.Extractor()
+            for x in [1, 2, 1, 3, 2]:
+                e.next2(x)
+        finally:
+            mrge.setTracer()
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert {record['point'] for record in records} == {'next2', 'insert'}, "Trace points are not filtered"
+        assert [record['event'] for record in records if record['point'] == 'next2'] == [1, 3, 5], \
+            "Trace is not sampled"
+        assert mrge.tracer is None
+
+    def testMetrics(self):
+        import json
+        # timers run when metrics are written only, counters always
+        untimed = mrge.Extractor(rounding=.5)
+        e = mrge.Extractor(rounding=.5)
+        e.timed = True
+        for extractor in (untimed, e):
+            for x in [1, 2, 1, 3, 2, 1, 1, 4]:
+                extractor.next2(x)
+            extractor.feed([2, 3])
+        assert untimed.stats.events == 10 and untimed.stats.digits == e.stats.digits, "Counters depend on the timers"
+        assert not any(untimed.stats.seconds.values()) and untimed.stats.latencyMax == 0
+        metrics = e.metrics()
+        assert metrics['events'] == 10 and metrics['digits'] == e.stats.digits > 0, "Bad event counters"
+        assert metrics['softResets'] > 0 and metrics['keys'] == 4
+        assert abs(metrics['entropyPerEvent'] - e.getTotalTheoreticalEntropy() / 10) < 1e-9
+        assert all(seconds >= 0 for seconds in metrics['seconds'].values()) and metrics['latency']['max'] > 0
+        text = mrge.Metrics.prometheus(metrics)
+        assert "mrge_events_total 10\n" in text and 'mrge_stage_seconds_total{stage="probs"}' in text, \
+            "Bad Prometheus text"
+        fname = self.tempName('metrics')
+        mrge.Metrics.write(fname, metrics, 'json')
+        with open(fname) as inFile:
+            assert json.load(inFile) == metrics, "Bad JSON metrics"
+
+    def testRevGathering(self):
+        import random
+        from math import log
+        rand = random.Random(7)
+        for kwargs in [{'revEntropy': 30}, {'revBlock': 25}, {'revEntropy': 12, 'revBlock': 40}, {'revEntropy': 20, 'str2cmp': str}]:
+            e = mrge.Extractor(**kwargs)
+            for i in range(200):
+                item = rand.choice([1, 2, 2, 3, 5.5])
+                e.insNewGetProb(str(item) if 'str2cmp' in kwargs else item)
+                expected = mrge.Extractor.getNumOfNewBits2(
+                    0, 0, history=e.backlog, storage=e.storage, revEnt=e.revEntropy, revBlock=e.revBlock, base=e.base)
+                assert e.revNewBits() == expected, f"Bad release decision with {kwargs} at event {i}"
+                assert abs(e.backlogInformation() + sum(log(e.getProbs(x, e.storage)[0], 2) for x in e.backlog)) < 1e-9
+                if expected:
+                    assert e.revInterval == mrge.Extractor.recalcInterval2(e.backlog, e.storage)
+            # backlog replaced by a soft reset is counted anew
+            e.softReset()
+            item = '1' if 'str2cmp' in kwargs else 1
+            e.insNewGetProb(item)
+            assert abs(e.backlogInformation() + log(e.getProbs(item, e.storage)[0], 2)) < 1e-9
+        # events gathered before convert2stringing are not in the new storage
+        for kwargs in [{'revEntropy': 8}, {'revBlock': 6}]:
+            e = mrge.Extractor(**kwargs)
+            for item in [1, 2, 1, 3]:
+                e.next2(item)
+            e.convert2stringing()
+            for item in 'abcabdabca':
+                e.insNewGetProb(item)
+                assert e.revNewBits() == mrge.Extractor.getNumOfNewBits2(
+                    0, 0, history=e.backlog, storage=e.storage, revEnt=e.revEntropy, revBlock=e.revBlock, base=e.base)
+
+    def testSharded(self):
+        import random
+        rand = random.Random(9)
+        numbers = [str(rand.choice([1, 2, 3, 4.5, 7])) for i in range(310)]
+        inName, outName = ".test.shard.in", ".test.shard.out"
+        shardBatch, mrge.Extractor.shardBatch = mrge.Extractor.shardBatch, 20
+        try:
+            # strings start on a round boundary and in the middle of a round
+            for lines in (numbers[:300] + ['a', 'b', '1', 'a'] * 10, numbers + ['a', 'b', '1', 'a'] * 10):
+                with open(inName, 'w') as inFile:
+                    inFile.write('\n'.join(lines) + '\n')
+                for shard in ('roundrobin', 'hash'):
+                    mrge.Extractor(inp=inName, outp=outName, workers=3, shard=shard, revEntropy=5).loop()
+                    with open(outName) as outFile:
+                        output = outFile.read()
+                    # same rounds of 3*20 events in one process, the round is cut short by the first string
+                    workers = [mrge.Extractor(revEntropy=5) for i in range(3)]
+                    expected = []
+
+                    def dispatch(batch):
+                        parts = [[] for i in range(3)]
+                        for i, item in enumerate(batch):
+                            parts[mrge.Extractor.shardHash(item) % 3 if shard == 'hash' else i % 3].append(item)
+                        for e, part in zip(workers, parts):
+                            if part:
+                                expected.extend(e.feed(part))
+                        batch.clear()
+                    batch = []
+                    for line in lines:
+                        try:
+                            item = float(line) if workers[0].input2object is float else line
+                        except ValueError:
+                            dispatch(batch)
+                            for e in workers:
+                                e.convert2stringing()
+                            item = line
+                        batch.append(item)
+                        if len(batch) >= 60:
+                            dispatch(batch)
+                    dispatch(batch)
+                    assert output == ''.join(map(str, expected)), f"Bad {shard} sharded output of {len(lines)} events"
+        finally:
+            mrge.Extractor.shardBatch = shardBatch
+        for fname in (inName, outName):
+            os.remove(fname)
+        assert mrge.Extractor.shardHash('abc') == 891568578, "String hash is not stable"
+
+    def testBlocks(self):
+        import random
+        from math import log
+        rand = random.Random(12)
+        lines = [str(rand.choice([1, 2, 2, 3, 4.5, 7])) for i in range(230)] + ['b', 'a', 'b', 'c'] * 5
+        inName, outName = ".test.blocks.in", ".test.blocks.out"
+        with open(inName, 'w') as inFile:
+            inFile.write('\n'.join(lines) + '\n')
+        numbers, strings = [float(line) for line in lines[:230]], lines[230:]
+        # strings are ordered by arrival like in the enumerator: b, a, c
+        blocks = [numbers[i:i + 50] for i in range(0, 230, 50)] + [[{'b': 0, 'a': 1, 'c': 2}[x] for x in strings]]
+        for blockStats in ('own', 'previous'):
+            e = mrge.Extractor(inp=inName, outp=outName, blockSize=50, blockStats=blockStats, workers=2)
+            e.loop()
+            with open(outName) as outFile:
+                output = outFile.read()
+            expected = []
+            entropy = 0
+            for i, block in enumerate(blocks):
+                probs = None
+                if blockStats == 'previous' and 0 < i < len(blocks) - 1:
+                    counts = mrge.Extractor.history2storage(numbers[:50 * i])
+                    probs = {x: mrge.Extractor.getProbs(x, counts) for x in block}
+                    entropy += sum(-log(probs[x][0], 2) for x in block if probs[x][0])
+                else:
+                    entropy += mrge.CountingStorage(mrge.Extractor.history2storage(block)).entropy()
+                expected += mrge.blockDigits(block, probs)
+            assert output == ''.join(map(str, expected)), f"Bad output of {blockStats} blocks"
+            assert abs(e.entropyAccumulator - entropy) < 1e-6 and e.entropyAccumulator >= len(output), \
+                f"Entropy of {blockStats} blocks is not accumulated"
+        # block with own counts is the rev-block release
+        for block in blocks:
+            assert list(mrge.blockDigits(block, None, 3)) == mrge.Extractor.soutputApproximation2(
+                history=block, storage=mrge.Extractor.history2storage(block), base=3)
+        assert list(mrge.blockDigits([0, 1, 1, 0, 1], {0: (fr(1, 3), 0), 1: (fr(2, 3), fr(1, 3))})) == \
+            mrge.Extractor.soutputApproximation2(history=[0, 1, 1, 0, 1], storage={0: fr(1, 3), 1: fr(2, 3)})
+        for fname in (inName, outName):
+            os.remove(fname)
+
+    def testService(self):
+        import asyncio
+        import io
+        import random
+        rand = random.Random(3)
+        lines = [str(rand.randint(0, 9)) for i in range(2000)]
+        expected = io.BytesIO()
+        e = mrge.Extractor(instream=lines, rounding=.5, outputFormat='binary')
+        e.outp = expected
+        e.loop()
+        expected = expected.getvalue()
+        path = ".test.service.sock"
+
+        async def session():
+            service = mrge.EntropyService(mrge.Extractor(
+                instream=lines, rounding=.5), poolBytes=100)
+            server = asyncio.create_task(service.run(unixPath=path))
+            while not os.path.exists(path):
+                await asyncio.sleep(.01)
+
+            async def client(n, count):
+                reader, writer = await asyncio.open_unix_connection(path)
+                chunks = []
+                for i in range(count):
+                    writer.write(n.to_bytes(4, 'big'))
+                    length = int.from_bytes(await reader.readexactly(4), 'big')
+                    chunks.append(await reader.readexactly(length))
+                writer.close()
+                return chunks
+            # client that is gone before its response gives the bytes back
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write((2 * len(expected)).to_bytes(4, 'big'))
+            writer.close()
+            served = await asyncio.gather(*(client(n, 10) for n in (7, 30, 1)))
+            rest = await client(len(expected), 2)
+            server.cancel()
+            return served, rest
+        served, rest = asyncio.run(session())
+        assert all(len(chunk) == n for chunks, n in zip(served, (7, 30, 1)) for chunk in chunks), \
+            "Short response while input is not over"
+        assert rest[1] == b'', "Response after the end of input is not empty"
+        assert sorted(b''.join(b''.join(chunks) for chunks in served) + rest[0]) == sorted(expected), "Bytes are lost"
+        assert not os.path.exists(path), "Socket is left"
+        # a file that is not a socket is not removed
+        with open(path, 'w') as f:
+            f.write('keep')
+        service = mrge.EntropyService(mrge.Extractor(instream=lines))
+        with self.assertRaises(FileExistsError):
+            asyncio.run(service.run(unixPath=path))
+        with open(path) as f:
+            assert f.read() == 'keep', "File is replaced by the socket"
+        os.remove(path)
+
+    def testEntropyPool(self):
+        import io
+        import random
+        import threading
+        rand = random.Random(8)
+        lines = [str(rand.randint(0, 9)) for i in range(2000)]
+        expected = io.BytesIO()
+        e = mrge.Extractor(instream=lines, rounding=.5, outputFormat='binary')
+        e.outp = expected
+        e.loop()
+        expected = expected.getvalue()
+        with mrge.EntropyPool(mrge.Extractor(instream=lines, rounding=.5), capacity=50) as pool:
+            data = pool.read(7) + pool.read(300) + pool.read(1)
+            data += pool.read(len(expected))
+            assert data == expected, "Bad bytes of the pool"
+            assert pool.read(5) == b'' and pool.tryRead(1) is None and pool.available() == 0
+            pool.unread(b'back')
+            assert pool.available() == 4 and pool.read(10) == b'back', "Bytes given back are lost"
+        # input that waits
+        release = threading.Event()
+
+        def slowInput():
+            yield from lines[:1000]
+            release.wait()
+            yield from lines[1000:]
+        pool = mrge.EntropyPool(mrge.Extractor(instream=slowInput(), rounding=.5), capacity=10000)
+        head = pool.read(100)
+        assert len(pool.read(len(expected), timeout=.2)) < len(expected) - 100, "Read did not time out"
+        assert pool.tryRead(1) is None, "Bytes out of nothing"
+        release.set()
+        pool.thread.join(5)
+        assert pool.available() > 0 and pool.tryRead(pool.available()) is not None
+        pool.close()
+
+    def testSources(self):
+        import io
+        import os
+        import random
+        import tempfile
+        import threading
+        rand = random.Random(9)
+        contents = [[str(rand.randint(0, 5)) for i in range(3000)],
+                    [str(rand.random()) for i in range(1500)],
+                    [str(rand.randint(0, 99)) for i in range(2000)]]
+        alone = []
+        for lines in contents:
+            out = io.StringIO()
+            e = mrge.Extractor(instream=lines)
+            e.outp = out
+            e.loop()
+            alone.append(out.getvalue())
+        with tempfile.TemporaryDirectory() as d:
+            names = [os.path.join(d, f"{i}.txt") for i in range(2)] + [os.path.join(d, 'pipe')]
+            for name, lines in zip(names, contents):
+                with open(name, 'w') as f:
+                    f.write('\n'.join(lines))
+            os.remove(names[2])
+            os.mkfifo(names[2])
+
+            def writePipe():
+                with open(names[2], 'w') as f:
+                    for i in range(0, len(contents[2]), 100):
+                        f.write(''.join(line + '\n' for line in contents[2][i:i + 100]))
+                        f.flush()
+            writer = threading.Thread(target=writePipe)
+            writer.start()
+            out = io.StringIO()
+            e = mrge.Extractor(inp=names)
+            e.outp = out
+            e.loop()
+            writer.join()
+        merged = out.getvalue()
+        assert len(merged) == sum(map(len, alone)) and sorted(merged) == sorted(''.join(alone)), "Sources lost digits"
+        metrics = e.metrics()
+        assert metrics['events'] == sum(map(len, contents))
+        assert [metrics['sources'][name]['digits'] for name in names] == list(map(len, alone)), "Bad metrics of sources"
+
 
 if __name__ == "__main__":
     mrge.setLogger(5)
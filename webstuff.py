@@ -12,21 +12,6 @@ class StreamlitFlushable:
         return
 
 
-class StringerFlushable:
-    def __init__(self):
-        self.accumulator = []
-
-    def write(self, *args, **kwargs):
-        for value in args:
-            self.accumulator.append(value)
-
-    def flush(self):
-        return
-
-    def __str__(self):
-        return ''.join(map(str, self.accumulator))
-
-
 def loadFile(container):
     fileIn = container.file_uploader(label='Pick a .txt file', type='txt')
     if fileIn is None:
@@ -61,7 +46,7 @@ if __name__ == '__main__':
         cont1.empty()
         cont2.empty()
         cont3.empty()
-        lines = file.getvalue().decode("UTF-8")
+        lines = file.getvalue().decode("UTF-8").splitlines()
         for line in lines:
             print(line)
         # st.empty()
@@ -69,7 +54,9 @@ if __name__ == '__main__':
         e = mrge.Extractor(instream=lines)
         # this class has a .write so should be valid # valid indeed
         #e.outp = StreamlitFlushable()
-        stringer = StringerFlushable()
-        e.outp = stringer
-        e.loop()
-        st.write(stringer)
+        # output comes in chunks through the bounded pool, same as for the service
+        bits = []
+        with mrge.EntropyPool(e) as pool:
+            for chunk in iter(lambda: pool.read(4096), b''):
+                bits.append(''.join(f'{byte:08b}' for byte in chunk))
+        st.write(''.join(bits))